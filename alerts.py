@@ -0,0 +1,334 @@
+import logging
+import os
+import threading
+import time
+from collections import OrderedDict
+
+import requests
+
+from http_pool import create_session
+from lifecycle import ALERTS, on_shutdown
+from metrics import REGISTRY, TELEGRAM_SEND_SECONDS, TELEGRAM_SENDS
+
+TELEGRAM_API_BASE = os.environ.get('TELEGRAM_API_BASE', 'https://api.telegram.org')
+TELEGRAM_MAX_MESSAGE = 4096  # in UTF-16 code units, so most emoji count twice
+
+
+def utf16_len(text):
+    """Length of text as Telegram counts it"""
+    return len(text.encode('utf-16-le')) // 2
+
+
+def split_message(text, limit=TELEGRAM_MAX_MESSAGE):
+    """Pieces of text within Telegram's length limit
+
+    Pieces break between coalesced messages (blank lines) where they can;
+    a single message over the limit is cut at the last code point that fits.
+    """
+    chunks = []
+    current = ''
+    for part in text.split('\n\n'):
+        joined = f"{current}\n\n{part}" if current else part
+        if utf16_len(joined) <= limit:
+            current = joined
+            continue
+        if current:
+            chunks.append(current)
+        while utf16_len(part) > limit:
+            units = cut = 0
+            while units + (2 if ord(part[cut]) > 0xFFFF else 1) <= limit:
+                units += 2 if ord(part[cut]) > 0xFFFF else 1
+                cut += 1
+            chunks.append(part[:cut])
+            part = part[cut:]
+        current = part
+    if current:
+        chunks.append(current)
+    return chunks
+
+
+class Alerter:
+    """Strategy interface for delivering slot alerts"""
+
+    def send(self, config, message):
+        """Deliver message for the monitor described by config"""
+        raise NotImplementedError
+
+
+class TelegramAlerter(Alerter):
+    """Queues alerts on the Telegram dispatcher so the poller never waits on Telegram"""
+
+    def __init__(self, parse_mode='HTML', dispatcher=None):
+        self.parse_mode = parse_mode
+        self.dispatcher = dispatcher
+
+    def send(self, config, message):
+        dispatcher = self.dispatcher or get_dispatcher()
+        if not dispatcher.enqueue(config['bot_token'], config['chat_id'], message, self.parse_mode):
+            raise Exception("Telegram alert queue is full")
+
+
+class TokenBucket:
+    """Refills rate tokens per second up to capacity"""
+
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+        self.blocked_until = 0  # set from Telegram's retry_after
+
+    def delay(self, now):
+        """Seconds until a token is available"""
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        wait = 0 if self.tokens >= 1 else (1 - self.tokens) / self.rate
+        return max(wait, self.blocked_until - now)
+
+    def consume(self):
+        self.tokens -= 1
+
+
+class PendingAlert:
+    """Messages waiting to go to one chat, sent together as one message"""
+
+    def __init__(self, bot_token, chat_id, parse_mode, now):
+        self.bot_token = bot_token
+        self.chat_id = chat_id
+        self.parse_mode = parse_mode
+        self.messages = []
+        self.first_at = now
+        self.not_before = now
+        self.attempts = 0
+
+    def text(self):
+        """All queued messages, deduplicated, as one message body"""
+        return '\n\n'.join(dict.fromkeys(self.messages))
+
+
+class AlertDispatcher:
+    """Background sender for Telegram alerts
+
+    Alerts for the same bot and chat that arrive within coalesce_window
+    seconds go out as one message. Sends respect a global and a per-chat
+    token bucket, and a 429 blocks the chat for the advertised retry_after.
+    One pooled session is reused for every request.
+    """
+
+    def __init__(self, api_base=None, coalesce_window=1.0, global_rate=30, chat_rate=1,
+                 max_queue=10000, max_attempts=5, timeout=10):
+        self.api_base = (api_base or TELEGRAM_API_BASE).rstrip('/')
+        self.coalesce_window = coalesce_window
+        self.chat_rate = chat_rate
+        self.max_queue = max_queue
+        self.max_attempts = max_attempts
+        self.timeout = timeout
+        self.session = None
+        self.thread = None
+        self.pending = OrderedDict()  # (bot_token, chat_id, parse_mode) -> PendingAlert
+        self.queued = 0
+        self.sent = 0
+        self.failed = 0
+        self.dropped = 0
+        self.in_flight = 0
+        self.global_bucket = TokenBucket(global_rate, global_rate)
+        self.chat_buckets = {}
+        self._running = False
+        self._draining = False
+        self._cond = threading.Condition()
+
+    def is_running(self):
+        """Check if the sender thread is alive"""
+        return self.thread is not None and self.thread.is_alive()
+
+    def start(self):
+        """Start the sender thread"""
+        with self._cond:
+            if self.is_running():
+                return False
+            if self.session is None:
+                self.session = create_session(pool_size=2)
+            self._running = True
+            self.thread = threading.Thread(target=self._run, daemon=True, name='alert-dispatcher')
+            self.thread.start()
+            return True
+
+    def stop(self, timeout=5):
+        """Stop the sender thread; queued alerts stay pending"""
+        with self._cond:
+            if not self.is_running():
+                return False
+            self._running = False
+            self._cond.notify_all()
+        self.thread.join(timeout=timeout)
+        return True
+
+    def drain(self, timeout=10):
+        """Send everything queued without waiting out coalescing windows, then stop
+
+        Rate limits still apply. Returns the number of alerts left undelivered.
+        """
+        if self.queued or self.in_flight:
+            self.start()  # no-op if already running
+            with self._cond:
+                self._draining = True
+                self._cond.notify_all()
+                self._cond.wait_for(lambda: not self.queued and not self.in_flight, timeout)
+        undelivered = self.queued
+        self.stop()
+        if undelivered:
+            logging.warning("Shutting down with %d Telegram alerts undelivered", undelivered)
+        return undelivered
+
+    def enqueue(self, bot_token, chat_id, message, parse_mode=None):
+        """Queue a message; returns False if the queue is full"""
+        if not self.is_running():
+            self.start()
+        with self._cond:
+            if self.queued >= self.max_queue:
+                self.dropped += 1
+                return False
+            key = (bot_token, str(chat_id), parse_mode)
+            alert = self.pending.get(key)
+            if alert is None:
+                alert = self.pending[key] = PendingAlert(bot_token, str(chat_id), parse_mode, time.monotonic())
+            alert.messages.append(message)
+            self.queued += 1
+            self._cond.notify()
+        return True
+
+    def get_stats(self):
+        """Queue depth and delivery counters"""
+        return {
+            'queued': self.queued,
+            'chats_pending': len(self.pending),
+            'in_flight': self.in_flight,
+            'sent': self.sent,
+            'failed': self.failed,
+            'dropped': self.dropped
+        }
+
+    def _run(self):
+        while True:
+            with self._cond:
+                alert = self._next_ready()
+                while alert is None:
+                    if not self._running:
+                        return
+                    self._cond.wait(self._wait_time())
+                    alert = self._next_ready()
+                del self.pending[(alert.bot_token, alert.chat_id, alert.parse_mode)]
+                self.queued -= len(alert.messages)
+                self.in_flight += 1
+            try:
+                self._deliver(alert)
+            finally:
+                with self._cond:
+                    self.in_flight -= 1
+                    self._cond.notify_all()
+
+    def _chat_bucket(self, alert):
+        key = (alert.bot_token, alert.chat_id)
+        bucket = self.chat_buckets.get(key)
+        if bucket is None:
+            bucket = self.chat_buckets[key] = TokenBucket(self.chat_rate, 1)
+        return bucket
+
+    def _next_ready(self):
+        """First alert whose coalescing window and rate limits allow sending"""
+        now = time.monotonic()
+        if self.global_bucket.delay(now) > 0:
+            return None
+        for alert in self.pending.values():
+            if (alert.first_at + self.coalesce_window > now and not self._draining) or alert.not_before > now:
+                continue
+            bucket = self._chat_bucket(alert)
+            if bucket.delay(now) > 0:
+                continue
+            bucket.consume()
+            self.global_bucket.consume()
+            return alert
+        return None
+
+    def _wait_time(self):
+        """How long the sender can sleep before something may become ready"""
+        if not self.pending:
+            return None
+        now = time.monotonic()
+        wait = self.global_bucket.delay(now)
+        window = 0 if self._draining else self.coalesce_window
+        soonest = min(max(alert.first_at + window, alert.not_before,
+                          now + self._chat_bucket(alert).delay(now)) for alert in self.pending.values())
+        return max(wait, soonest - now, 0.01)
+
+    def _deliver(self, alert):
+        chunks = split_message(alert.text())
+        url = f"{self.api_base}/bot{alert.bot_token}/sendMessage"
+        index = 0
+        try:
+            for index, chunk in enumerate(chunks):
+                payload = {'chat_id': alert.chat_id, 'text': chunk}
+                if alert.parse_mode:
+                    payload['parse_mode'] = alert.parse_mode
+                started = time.perf_counter()
+                try:
+                    response = self.session.post(url, json=payload, timeout=self.timeout)
+                finally:
+                    TELEGRAM_SEND_SECONDS.observe(time.perf_counter() - started)
+                if response.status_code == 429:
+                    TELEGRAM_SENDS.inc('rate_limited')
+                    alert.messages = chunks[index:]  # only what hasn't gone out yet
+                    self._retry(alert, self._retry_after(response))
+                    return
+                response.raise_for_status()
+                TELEGRAM_SENDS.inc('ok')
+            self.sent += 1
+            logging.info("Telegram alert sent (%d coalesced)", len(alert.messages), extra={'chat_id': alert.chat_id})
+        except requests.RequestException as e:
+            TELEGRAM_SENDS.inc('error')
+            logging.error("Failed to send Telegram alert: %s", e, extra={'chat_id': alert.chat_id})
+            alert.messages = chunks[index:]
+            self._retry(alert, min(2 ** alert.attempts, 60))
+
+    def _retry_after(self, response):
+        try:
+            return float(response.json()['parameters']['retry_after'])
+        except (ValueError, KeyError, TypeError):
+            return float(response.headers.get('Retry-After', 1))
+
+    def _retry(self, alert, delay):
+        """Put an undelivered alert back, merging with anything queued since"""
+        alert.attempts += 1
+        if alert.attempts >= self.max_attempts:
+            self.failed += 1
+            logging.error("Giving up on Telegram alert after %d attempts", alert.attempts, extra={'chat_id': alert.chat_id})
+            return
+
+        logging.warning("Retrying Telegram alert in %.1fs", delay, extra={'chat_id': alert.chat_id})
+        now = time.monotonic()
+        with self._cond:
+            self._chat_bucket(alert).blocked_until = now + delay
+            key = (alert.bot_token, alert.chat_id, alert.parse_mode)
+            newer = self.pending.pop(key, None)
+            if newer:
+                alert.messages.extend(newer.messages)
+            alert.not_before = now + delay
+            self.pending[key] = alert
+            self.pending.move_to_end(key, last=False)
+            self.queued += len(alert.messages) - (len(newer.messages) if newer else 0)
+            self._cond.notify()
+
+
+_dispatcher = None
+_dispatcher_lock = threading.Lock()
+
+
+def get_dispatcher():
+    """Get the process-wide alert dispatcher"""
+    global _dispatcher
+    with _dispatcher_lock:
+        if _dispatcher is None:
+            _dispatcher = AlertDispatcher()
+            REGISTRY.register_stats('telegram_alerts', _dispatcher.get_stats, counters=('sent', 'failed', 'dropped'))
+            on_shutdown(ALERTS, 'alert dispatcher', _dispatcher.drain)
+        return _dispatcher
@@ -0,0 +1,288 @@
+import hmac
+import json
+import os
+import threading
+import time
+from datetime import datetime, timedelta, timezone
+
+from flask import Blueprint, Response, abort, jsonify, make_response, request, stream_with_context
+
+import bulk
+import lifecycle
+from metrics import REGISTRY
+from models import CheckResult, MonitorLog
+
+# Longest a long-poll or SSE wait may block before answering or sending a keepalive
+MAX_WAIT = 25
+
+# Each open event stream or long-poll holds a worker thread, so a worker
+# keeps at most MONITOR_MAX_STREAMS of them (leave some of gunicorn's
+# threads for plain requests). A stream ends after MAX_STREAM_SECONDS and
+# the browser reconnects, which spreads streams across workers.
+MAX_STREAMS = int(os.environ.get('MONITOR_MAX_STREAMS', 8))
+MAX_STREAM_SECONDS = 300
+_stream_slots = threading.BoundedSemaphore(MAX_STREAMS)
+
+# Most history rows one page may ask for
+MAX_PAGE = 500
+
+
+def serialize_status(monitor):
+    """JSON-safe status for a monitor"""
+    status = dict(monitor.get_status())
+    for field in ('last_check', 'last_changed'):
+        if status.get(field):
+            status[field] = status[field].isoformat() + 'Z'
+    status['is_monitoring'] = monitor.is_running()
+    return status
+
+
+def serialize_log(seq, entry):
+    """JSON-safe log entry with its sequence number"""
+    return {
+        'seq': seq,
+        'timestamp': entry.created.isoformat() + 'Z',
+        'level': entry.level,
+        'message': entry.message
+    }
+
+
+def _cursor(monitor, since):
+    """A cursor ahead of the buffer means the process restarted; start over"""
+    return 0 if since > monitor.last_log_seq else since
+
+
+def _time_arg(name):
+    """Naive UTC datetime from an ISO 8601 query arg, or None; 400 if malformed"""
+    value = request.args.get(name)
+    if not value:
+        return None
+    try:
+        timestamp = datetime.fromisoformat(value.replace('Z', '+00:00'))
+    except ValueError:
+        abort(make_response(jsonify(error=f"{name} must be an ISO 8601 time"), 400))
+    if timestamp.tzinfo:
+        timestamp = timestamp.astimezone(timezone.utc).replace(tzinfo=None)
+    return timestamp
+
+
+def _stream_slot():
+    """A release function if a stream slot is free, else None"""
+    if not _stream_slots.acquire(blocking=False):
+        return None
+    released = threading.Event()
+
+    def release():
+        if not released.is_set():
+            released.set()
+            _stream_slots.release()
+    return release
+
+
+def _int_arg(name, default):
+    try:
+        return int(request.args.get(name, default))
+    except (TypeError, ValueError):
+        return default
+
+
+def create_metrics_blueprint(store=None):
+    """/metrics in the Prometheus text format
+
+    With a shared_state.SharedStateStore the metrics the shard processes
+    publish are included, labelled by shard.
+    """
+    bp = Blueprint('metrics', __name__)
+
+    @bp.route('/metrics')
+    def metrics():
+        extra = store.load_metrics() if store else ()
+        return Response(REGISTRY.render(extra), mimetype='text/plain; version=0.0.4')
+
+    return bp
+
+
+def _require_admin():
+    """Abort unless the request carries the ADMIN_TOKEN bearer token"""
+    token = os.environ.get('ADMIN_TOKEN')
+    if not token:
+        abort(make_response(jsonify(error='Bulk endpoints are disabled; set ADMIN_TOKEN'), 403))
+    supplied = request.headers.get('Authorization', '')
+    if not hmac.compare_digest(supplied.encode(), f"Bearer {token}".encode()):
+        abort(make_response(jsonify(error='Admin token required'), 401))
+
+
+def create_bulk_blueprint(registry):
+    """Fleet-wide import and export, for ADMIN_TOKEN holders only
+
+    /api/monitors/import  POST CSV or JSON (raw body or a "file" upload);
+                          ?bot_token, ?chat_id, ?check_interval fill in
+                          missing columns and ?start=1 starts new monitors
+    /api/monitors/export  every monitor as ?format=csv (default) or json, streamed
+    """
+    bp = Blueprint('bulk', __name__, url_prefix='/api/monitors')
+
+    @bp.before_request
+    def check_token():
+        _require_admin()
+
+    @bp.route('/import', methods=['POST'])
+    def import_monitors():
+        upload = request.files.get('file')
+        data = upload.read() if upload else request.get_data()
+        fmt = request.args.get('format')
+        if not fmt:
+            name = upload.filename if upload else ''
+            mimetype = upload.mimetype if upload else request.mimetype
+            fmt = 'json' if name.lower().endswith('.json') or 'json' in (mimetype or '') else 'csv'
+        defaults = {name: request.values.get(name) for name in ('bot_token', 'chat_id', 'check_interval')}
+        defaults['running'] = request.values.get('start', '').lower() in bulk.TRUE_VALUES
+        try:
+            entries = bulk.parse_entries(data.decode('utf-8-sig'), fmt)
+            result = bulk.import_entries(registry, entries, defaults)
+        except (bulk.BulkError, UnicodeDecodeError) as e:
+            return jsonify(error=str(e)), 400
+        if result['errors']:
+            return jsonify(error='No monitors created; fix the rows listed', **result), 400
+        return jsonify(result), 201 if result['created'] else 200
+
+    @bp.route('/export')
+    def export_monitors():
+        fmt = request.args.get('format', 'csv')
+        if fmt not in ('csv', 'json'):
+            return jsonify(error="format must be csv or json"), 400
+        response = Response(bulk.export_rows(registry, fmt),
+                            mimetype='text/csv' if fmt == 'csv' else 'application/json')
+        response.headers['Content-Disposition'] = f"attachment; filename=monitors.{fmt}"
+        return response
+
+    return bp
+
+
+def create_api_blueprint(get_monitor):
+    """JSON and streaming status endpoints for the monitor returned by get_monitor()
+
+    A get_monitor() of None answers 404.
+
+    /api/status   current status
+    /api/logs     entries newer than ?since=<seq>; ?wait=<s> long-polls until one arrives
+    /api/events   Server-Sent Events stream of status and new log entries
+    /api/history/logs, /api/history/checks
+                  stored rows for the monitor's URL, newest first, a page at a
+                  time: ?level=, ?since=/?until= (ISO 8601) or ?window=<s>,
+                  ?limit=, and ?cursor= from the previous page's next_cursor
+    """
+    bp = Blueprint('api', __name__, url_prefix='/api')
+
+    def current_monitor():
+        monitor = get_monitor()
+        if monitor is None:
+            abort(make_response(jsonify(error='No monitor configured'), 404))
+        return monitor
+
+    @bp.route('/status')
+    def status():
+        monitor = current_monitor()
+        return jsonify(version=monitor.version, status=serialize_status(monitor))
+
+    @bp.route('/logs')
+    def logs():
+        monitor = current_monitor()
+        since = _cursor(monitor, _int_arg('since', 0))
+        wait = min(_int_arg('wait', 0), MAX_WAIT)
+        limit = _int_arg('limit', 0) or None
+
+        version = monitor.version
+        items = monitor.get_log_items(since, limit)
+        release = _stream_slot() if wait and not items else None
+        try:
+            deadline = time.monotonic() + wait
+            while not items and release and not lifecycle.stopping.is_set():
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                version = monitor.wait_for_change(version, remaining)
+                items = monitor.get_log_items(since, limit)
+        finally:
+            if release:
+                release()
+
+        seq = items[0][0] if items else since
+        return jsonify(seq=seq, logs=[serialize_log(s, entry) for s, entry in items])
+
+    def history_page(model, **filters):
+        monitor = current_monitor()
+        since = _time_arg('since')
+        window = _int_arg('window', 0)
+        if window > 0:
+            since = max(since or datetime.min, datetime.utcnow() - timedelta(seconds=window))
+        limit = min(max(_int_arg('limit', 50), 1), MAX_PAGE)
+        try:
+            return model.page(testflight_url=monitor.config['testflight_url'], since=since, until=_time_arg('until'),
+                              cursor=request.args.get('cursor'), limit=limit, **filters)
+        except ValueError:
+            abort(make_response(jsonify(error='Invalid cursor'), 400))
+
+    @bp.route('/history/logs')
+    def history_logs():
+        level = request.args.get('level')
+        rows, next_cursor = history_page(MonitorLog, **({'level': level} if level else {}))
+        return jsonify(next_cursor=next_cursor, logs=[
+            {'id': row.id, 'timestamp': row.timestamp.isoformat() + 'Z', 'level': row.level, 'message': row.message}
+            for row in rows])
+
+    @bp.route('/history/checks')
+    def history_checks():
+        rows, next_cursor = history_page(CheckResult)
+        return jsonify(next_cursor=next_cursor, checks=[
+            {'id': row.id, 'timestamp': row.timestamp.isoformat() + 'Z', 'available': row.available,
+             'error': row.error} for row in rows])
+
+    @bp.route('/events')
+    def events():
+        monitor = current_monitor()
+        since = _int_arg('since', 0)
+        last_event_id = request.headers.get('Last-Event-ID')
+        if last_event_id and last_event_id.isdigit():
+            since = int(last_event_id)
+        since = _cursor(monitor, since)
+
+        # With every slot taken, send one snapshot and have the browser come back later
+        release = _stream_slot()
+        ends_at = time.monotonic() + MAX_STREAM_SECONDS
+
+        def stream():
+            version = None
+            last_status = None
+            cursor = since
+            yield 'retry: 3000\n\n' if release else 'retry: 15000\n\n'
+            while not lifecycle.stopping.is_set():
+                if version is not None:
+                    remaining = ends_at - time.monotonic()
+                    if not release or remaining <= 0:
+                        return
+                    new_version = monitor.wait_for_change(version, min(MAX_WAIT, remaining))
+                    if new_version == version:
+                        yield ': keepalive\n\n'
+                        continue
+                version = monitor.version
+
+                status = serialize_status(monitor)
+                if status != last_status:
+                    last_status = status
+                    yield f"event: status\ndata: {json.dumps(status)}\n\n"
+
+                items = monitor.get_log_items(cursor)
+                for seq, entry in reversed(items):  # oldest first
+                    yield f"id: {seq}\nevent: log\ndata: {json.dumps(serialize_log(seq, entry))}\n\n"
+                if items:
+                    cursor = items[0][0]
+
+        response = Response(stream_with_context(stream()), mimetype='text/event-stream')
+        response.headers['Cache-Control'] = 'no-cache'
+        response.headers['X-Accel-Buffering'] = 'no'
+        if release:
+            response.call_on_close(release)
+        return response
+
+    return bp
@@ -0,0 +1,348 @@
+"""Load test for the polling pipeline against local fake TestFlight and Telegram servers
+
+    python benchmark.py --scales 10,100,1000 --duration 60 --interval 5
+    python benchmark.py --mode web --scales 100 --latency 0.05 --error-rate 0.02 --json before.json
+    python benchmark.py --startup --scales 0,1000
+
+For each scale the monitors run in a child process, so its CPU and RSS
+are measured apart from the fake servers. Once every monitor has polled,
+random betas are opened during the run and the time from opening to the
+Telegram message arriving is recorded.
+
+--mode monitor drives TestFlightMonitor directly; --mode web configures
+and starts each monitor through web_app's routes, one browser session
+per URL, so the registry and history writer are included.
+
+--startup instead times how long a web worker takes to serve its first
+request with that many running monitors loaded: once importing web_app
+from scratch, and once forked from a process that already imported it,
+as gunicorn does with preload_app.
+"""
+import argparse
+import json
+import multiprocessing
+import os
+import random
+import re
+import resource
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+from fake_telegram import FakeTelegramServer
+from fake_testflight import FakeTestFlightServer
+
+
+def _rss_mb():
+    """Current resident set size of this process"""
+    with open('/proc/self/statm') as f:
+        pages = int(f.read().split()[1])
+    return pages * os.sysconf('SC_PAGE_SIZE') / 2 ** 20
+
+
+def _cpu_seconds():
+    usage = resource.getrusage(resource.RUSAGE_SELF)
+    return usage.ru_utime + usage.ru_stime
+
+
+def _start_monitors(urls, interval):
+    from monitor import TestFlightMonitor
+
+    monitors = []
+    for index, url in enumerate(urls):
+        monitor = TestFlightMonitor()
+        monitor.update_config({'bot_token': '1:bench', 'chat_id': str(index),
+                               'testflight_url': url, 'check_interval': interval})
+        monitor.start(stagger=True)
+        monitors.append(monitor)
+    return monitors
+
+
+def _start_web(urls, interval):
+    import web_app
+
+    for index, url in enumerate(urls):
+        client = web_app.app.test_client()
+        client.post('/configure', data={'bot_token': '1:bench', 'chat_id': str(index),
+                                        'testflight_url': url, 'check_interval': interval})
+        response = client.get('/start')
+        if response.status_code != 302:
+            raise RuntimeError(f"Starting monitor {index} failed with {response.status_code}")
+    return web_app.registry
+
+
+def _run_child(mode, urls, interval, concurrency, telegram_url, conn):
+    """System under test: runs the monitors until told to stop, then reports"""
+    os.environ['TELEGRAM_API_BASE'] = telegram_url
+    os.environ['MONITOR_MAX_CONCURRENCY'] = str(concurrency)
+    os.environ['DATABASE_URL'] = f"sqlite:///{tempfile.mkdtemp()}/bench.db"  # never the real database
+    os.environ.pop('MONITOR_WORKERS', None)
+    from logging_setup import setup_logging
+    setup_logging('WARNING')
+
+    from metrics import CHECK_SECONDS, CHECKS
+
+    started_cpu = _cpu_seconds()
+    started = time.monotonic()
+    keep = _start_monitors(urls, interval) if mode == 'monitor' else _start_web(urls, interval)
+    conn.send({'startup_seconds': time.monotonic() - started})
+
+    conn.recv()  # measurement starts
+    checks_before = sum(CHECKS.values.values())
+    errors_before = CHECKS.get('error')
+    cpu_before = _cpu_seconds()
+    measure_started = time.monotonic()
+    conn.recv()  # measurement ends
+    wall = time.monotonic() - measure_started
+
+    series = CHECK_SECONDS.series.get(())
+    conn.send({
+        'checks': sum(CHECKS.values.values()) - checks_before,
+        'errors': CHECKS.get('error') - errors_before,
+        'wall_seconds': wall,
+        'cpu_seconds': _cpu_seconds() - cpu_before,
+        'startup_cpu_seconds': cpu_before - started_cpu,
+        'rss_mb': _rss_mb(),
+        'peak_rss_mb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+        'mean_check_ms': series[-1] / sum(series[:-1]) * 1000 if series else None
+    })
+    del keep
+
+
+def _percentile(values, fraction):
+    if not values:
+        return None
+    values = sorted(values)
+    return values[min(len(values) - 1, int(round(fraction * (len(values) - 1))))]
+
+
+def run_scale(count, mode='monitor', duration=30, interval=5, latency=0.0, error_rate=0.0,
+              page_size=40000, flips=20, concurrency=50, verdict_offset=None):
+    """Benchmark one scale; returns a dict of results"""
+    with FakeTestFlightServer(latency=latency, error_rate=error_rate, page_size=page_size,
+                              verdict_offset=verdict_offset) as testflight, \
+            FakeTelegramServer() as telegram:
+        codes = [f"bench{index:05d}" for index in range(count)]
+        urls = [testflight.url_for(code) for code in codes]
+
+        parent, child = multiprocessing.get_context('spawn').Pipe()
+        process = multiprocessing.get_context('spawn').Process(
+            target=_run_child, args=(mode, urls, interval, concurrency, telegram.url, child))
+        process.start()
+        startup = parent.recv()
+
+        # Let every monitor make its staggered first poll before measuring
+        time.sleep(interval * 1.2)
+        parent.send('start')
+        requests_before = testflight.requests
+
+        # Open betas spread over the run, leaving time for the last alerts to arrive
+        opened = random.sample(codes, min(flips, count))
+        window = max(0.0, duration - interval * 2 - 3)
+        schedule = sorted((random.uniform(0, window), code) for code in opened)
+        measure_started = time.monotonic()
+        for offset, code in schedule:
+            time.sleep(max(0.0, measure_started + offset - time.monotonic()))
+            testflight.set_open(code)
+        time.sleep(max(0.0, measure_started + duration - time.monotonic()))
+
+        parent.send('stop')
+        child_stats = parent.recv()
+        process.join(10)
+        if process.is_alive():
+            process.terminate()
+
+        alerted_at = {}
+        for message in telegram.messages:
+            for code in re.findall(r'/join/(\w+)', message['text']):
+                alerted_at.setdefault(code, message['received_at'])
+        latencies = [alerted_at[code] - testflight.opened_at[code] for code in opened if code in alerted_at]
+
+        wall = child_stats['wall_seconds']
+        return {
+            'mode': mode,
+            'urls': count,
+            'interval': interval,
+            'checks_per_sec': child_stats['checks'] / wall,
+            'server_requests_per_sec': (testflight.requests - requests_before) / wall,
+            'errors': child_stats['errors'],
+            'alerts': len(latencies),
+            'missed_alerts': len(opened) - len(latencies),
+            'alert_p50_s': _percentile(latencies, 0.5),
+            'alert_p99_s': _percentile(latencies, 0.99),
+            'alert_mean_s': statistics.mean(latencies) if latencies else None,
+            'mean_check_ms': child_stats['mean_check_ms'],
+            'cpu_percent': child_stats['cpu_seconds'] / wall * 100,
+            'rss_mb': child_stats['rss_mb'],
+            'peak_rss_mb': child_stats['peak_rss_mb'],
+            'startup_seconds': startup['startup_seconds']
+        }
+
+
+def _seed_database(database_url, urls):
+    """Store a running monitor per URL, without loading or starting any"""
+    os.environ['DATABASE_URL'] = database_url
+    from flask import Flask
+    from database import db, init_db
+    from models import MonitorConfig
+
+    app = Flask('bench_seed')
+    init_db(app)
+    with app.app_context():
+        db.session.add_all([MonitorConfig(bot_token='1:bench', chat_id=str(index), testflight_url=url,
+                                          check_interval=60, running=True) for index, url in enumerate(urls)])
+        db.session.commit()
+
+
+# Run in a fresh interpreter: import web_app, serve one request, print the timings
+_COLD_START = """
+import json, os, sys, time
+started = time.perf_counter()
+import web_app
+imported = time.perf_counter()
+web_app.app.test_client().get('/metrics')
+print(json.dumps({'import': imported - started, 'ready': time.perf_counter() - started}), flush=True)
+os._exit(0)
+"""
+
+
+def _run_preforked(rounds, conn):
+    """Import web_app once as gunicorn's master would, then time forked workers"""
+    import lifecycle
+
+    lifecycle.preforking = True
+    started = time.perf_counter()
+    import web_app
+    conn.send({'warm_seconds': time.perf_counter() - started})
+
+    for _ in range(rounds):
+        read_end, write_end = os.pipe()
+        forked_at = time.perf_counter()
+        pid = os.fork()
+        if pid == 0:
+            os.close(read_end)
+            lifecycle.startup()
+            web_app.app.test_client().get('/metrics')
+            os.write(write_end, str(time.perf_counter() - forked_at).encode())
+            os._exit(0)
+        os.close(write_end)
+        with os.fdopen(read_end) as f:
+            conn.send(float(f.read()))
+        os.waitpid(pid, 0)
+    conn.send(None)
+
+
+def run_startup(count, rounds=5):
+    """Time web worker startup with count running monitors; returns a dict of results"""
+    with FakeTestFlightServer() as testflight:
+        urls = [testflight.url_for(f"bench{index:05d}") for index in range(count)]
+        env = dict(os.environ, LOG_LEVEL='WARNING', DATABASE_URL=f"sqlite:///{tempfile.mkdtemp()}/bench.db")
+        env.pop('MONITOR_WORKERS', None)
+        context = multiprocessing.get_context('spawn')
+        seed = context.Process(target=_seed_database, args=(env['DATABASE_URL'], urls))
+        seed.start()
+        seed.join()
+
+        cold = []
+        for _ in range(rounds):
+            started = time.perf_counter()
+            output = subprocess.run([sys.executable, '-c', _COLD_START], env=env, capture_output=True, text=True,
+                                    cwd=os.path.dirname(os.path.abspath(__file__)), check=True).stdout
+            timings = json.loads(output.strip().splitlines()[-1])
+            cold.append((time.perf_counter() - started, timings['import'], timings['ready']))
+
+        saved = dict(os.environ)
+        os.environ.update(env)  # the spawned child reads its environment from ours
+        try:
+            parent, child = context.Pipe()
+            process = context.Process(target=_run_preforked, args=(rounds, child))
+            process.start()
+        finally:
+            os.environ.clear()
+            os.environ.update(saved)
+        warm = parent.recv()['warm_seconds']
+        forked = list(iter(parent.recv, None))
+        process.join(10)
+        if process.is_alive():
+            process.terminate()
+
+    return {
+        'urls': count,
+        'cold_process_s': statistics.median(total for total, _, _ in cold),
+        'cold_import_s': statistics.median(imported for _, imported, _ in cold),
+        'cold_ready_s': statistics.median(ready for _, _, ready in cold),
+        'preload_import_s': warm,
+        'forked_ready_s': statistics.median(forked),
+        'forked_ready_max_s': max(forked)
+    }
+
+
+def print_startup_table(results):
+    columns = [('urls', 'monitors'), ('cold_process_s', 'cold process s'), ('cold_import_s', 'import s'),
+               ('cold_ready_s', 'ready s'), ('preload_import_s', 'preload s'), ('forked_ready_s', 'forked ready s'),
+               ('forked_ready_max_s', 'max s')]
+    rows = [[title for _, title in columns]] + [[_format(result[key], 3) for key, _ in columns] for result in results]
+    widths = [max(len(row[i]) for row in rows) for i in range(len(columns))]
+    for row in rows:
+        print('  '.join(cell.rjust(width) for cell, width in zip(row, widths)))
+
+
+def _format(value, digits=2):
+    if value is None:
+        return '-'
+    return f"{value:.{digits}f}" if isinstance(value, float) else str(value)
+
+
+def print_table(results):
+    columns = [('urls', 'URLs'), ('checks_per_sec', 'checks/s'), ('alert_p50_s', 'alert p50 s'),
+               ('alert_p99_s', 'alert p99 s'), ('missed_alerts', 'missed'), ('errors', 'errors'),
+               ('mean_check_ms', 'check ms'), ('cpu_percent', 'CPU %'), ('rss_mb', 'RSS MB'),
+               ('startup_seconds', 'startup s')]
+    rows = [[title for _, title in columns]] + [[_format(result[key]) for key, _ in columns] for result in results]
+    widths = [max(len(row[i]) for row in rows) for i in range(len(columns))]
+    for row in rows:
+        print('  '.join(cell.rjust(width) for cell, width in zip(row, widths)))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--mode', choices=('monitor', 'web'), default='monitor')
+    parser.add_argument('--scales', default='10,100,1000', help='comma-separated URL counts')
+    parser.add_argument('--duration', type=float, default=30, help='measured seconds per scale')
+    parser.add_argument('--interval', type=int, default=5, help='check interval per monitor')
+    parser.add_argument('--latency', type=float, default=0.0, help='fake TestFlight response delay')
+    parser.add_argument('--error-rate', type=float, default=0.0, help='fraction of requests answered with 503')
+    parser.add_argument('--page-size', type=int, default=40000, help='bytes per TestFlight page')
+    parser.add_argument('--verdict-offset', type=int, help='put the full/open text this many bytes in (default: end)')
+    parser.add_argument('--flips', type=int, default=20, help='betas opened per run')
+    parser.add_argument('--concurrency', type=int, default=50, help='MONITOR_MAX_CONCURRENCY for the run')
+    parser.add_argument('--json', help='also write results to this file')
+    parser.add_argument('--startup', action='store_true', help='time web worker startup instead')
+    parser.add_argument('--rounds', type=int, default=5, help='startups timed per scale with --startup')
+    args = parser.parse_args()
+
+    results = []
+    scales = [int(scale) for scale in args.scales.split(',')]
+    if args.startup:
+        for count in scales:
+            print(f"Timing startup with {count} monitors...", flush=True)
+            results.append(run_startup(count, args.rounds))
+        print()
+        print_startup_table(results)
+    else:
+        for count in scales:
+            print(f"Running {count} URLs ({args.mode} mode, {args.duration:.0f}s)...", flush=True)
+            results.append(run_scale(count, args.mode, args.duration, args.interval, args.latency,
+                                     args.error_rate, args.page_size, args.flips, args.concurrency,
+                                     args.verdict_offset))
+        print()
+        print_table(results)
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
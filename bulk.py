@@ -0,0 +1,221 @@
+"""Bulk import and export of monitors
+
+    python bulk.py import monitors.csv --bot-token 123:abc --start
+    python bulk.py import monitors.json --server https://monitor.example.com
+    python bulk.py export --format csv > monitors.csv
+
+Files are CSV with a header row, or JSON: a list of objects (or
+{"monitors": [...]}). Columns are testflight_url, chat_id, bot_token,
+check_interval and running; --bot-token, --chat-id and --interval fill
+in any that are missing. The CLI talks to a running server's
+/api/monitors endpoints, so new monitors start right away, and needs
+the server's ADMIN_TOKEN.
+"""
+import argparse
+import csv
+import io
+import json
+import os
+import re
+import sys
+from urllib.parse import urlsplit
+
+from urls import normalize_url
+
+FIELDS = ('testflight_url', 'chat_id', 'bot_token', 'check_interval', 'running')
+MAX_ENTRIES = 10000
+MIN_INTERVAL = 5
+MAX_INTERVAL = 86400
+
+TESTFLIGHT_HOST = 'testflight.apple.com'
+JOIN_PATH = re.compile(r'^/join/[A-Za-z0-9]+$')
+BOT_TOKEN = re.compile(r'^\d+:[A-Za-z0-9_-]+$')
+CHAT_ID = re.compile(r'^(?:-?\d+|@[A-Za-z][A-Za-z0-9_]{4,})$')
+
+TRUE_VALUES = ('1', 'true', 'yes', 'y', 'on')
+
+
+class BulkError(ValueError):
+    """The upload couldn't be read at all, as opposed to bad rows"""
+
+
+def parse_entries(data, fmt):
+    """Rows as dicts from CSV or JSON text"""
+    if fmt == 'json':
+        try:
+            entries = json.loads(data)
+        except ValueError as e:
+            raise BulkError(f"Invalid JSON: {e}")
+        if isinstance(entries, dict):
+            entries = entries.get('monitors')
+        if not isinstance(entries, list) or not all(isinstance(entry, dict) for entry in entries):
+            raise BulkError("Expected a list of monitor objects")
+        return entries
+    if fmt == 'csv':
+        reader = csv.DictReader(io.StringIO(data))
+        if not reader.fieldnames or 'testflight_url' not in [name.strip() for name in reader.fieldnames]:
+            raise BulkError("CSV needs a header row with at least a testflight_url column")
+        return [{(key or '').strip(): value for key, value in row.items()} for row in reader]
+    raise BulkError(f"Unknown format {fmt!r}; use csv or json")
+
+
+def validate_url(url):
+    """Canonical join URL, or raise ValueError"""
+    parts = urlsplit(url.strip())
+    if parts.scheme not in ('http', 'https') or (parts.hostname or '').lower() != TESTFLIGHT_HOST:
+        raise ValueError(f"not a {TESTFLIGHT_HOST} URL")
+    if not JOIN_PATH.match(parts.path.rstrip('/')):
+        raise ValueError("expected a /join/<code> link")
+    return normalize_url(url)
+
+
+def validate_entry(entry, defaults):
+    """Config dict and running flag for one row, or raise ValueError"""
+    def field(name):
+        value = entry.get(name)
+        if value is None or str(value).strip() == '':
+            value = defaults.get(name)
+        return None if value is None else str(value).strip()
+
+    url = field('testflight_url')
+    if not url:
+        raise ValueError("testflight_url is required")
+    bot_token = field('bot_token')
+    if not bot_token or not BOT_TOKEN.match(bot_token):
+        raise ValueError("bot_token is missing or malformed")
+    chat_id = field('chat_id')
+    if not chat_id or not CHAT_ID.match(chat_id):
+        raise ValueError("chat_id is missing or malformed")
+    try:
+        interval = int(field('check_interval') or 60)
+    except ValueError:
+        raise ValueError("check_interval must be a whole number of seconds")
+    if not MIN_INTERVAL <= interval <= MAX_INTERVAL:
+        raise ValueError(f"check_interval must be between {MIN_INTERVAL} and {MAX_INTERVAL}")
+    running = field('running')
+    config = {
+        'bot_token': bot_token,
+        'chat_id': chat_id,
+        'testflight_url': validate_url(url),
+        'check_interval': interval
+    }
+    return config, running.lower() in TRUE_VALUES if running else bool(defaults.get('running'))
+
+
+def import_entries(registry, entries, defaults=None):
+    """Validate, dedupe and create monitors; returns a JSON-able summary
+
+    Nothing is created if any row is invalid. Rows repeating a URL and
+    chat already in the upload or already registered are skipped. Rows
+    are numbered from 1; for CSV that's the line after the header.
+    """
+    defaults = defaults or {}
+    if len(entries) > MAX_ENTRIES:
+        raise BulkError(f"At most {MAX_ENTRIES} monitors per import")
+
+    errors = []
+    seen = set()
+    configs = []
+    running = []
+    duplicates = 0
+    for row, entry in enumerate(entries, 1):
+        try:
+            config, start = validate_entry(entry, defaults)
+        except ValueError as e:
+            errors.append({'row': row, 'error': str(e)})
+            continue
+        identity = (config['testflight_url'], config['chat_id'])
+        if identity in seen or registry.find(*identity):
+            duplicates += 1
+            continue
+        seen.add(identity)
+        configs.append(config)
+        running.append(start)
+
+    if errors:
+        return {'created': 0, 'duplicates': duplicates, 'errors': errors}
+    ids = registry.create_many(configs, running=running) if configs else []
+    return {'created': len(ids), 'duplicates': duplicates, 'errors': [], 'ids': ids}
+
+
+def export_rows(registry, fmt, batch_size=500):
+    """Stream every monitor as CSV or JSON text chunks"""
+    rows = registry.iter_configs(batch_size)
+    if fmt == 'csv':
+        buffer = io.StringIO()
+        writer = csv.writer(buffer)
+        writer.writerow(('id',) + FIELDS)
+        for count, (monitor_id, config, running) in enumerate(rows, 1):
+            writer.writerow([monitor_id] + [config[name] for name in FIELDS[:-1]] + [int(running)])
+            if count % batch_size == 0:
+                yield buffer.getvalue()
+                buffer.seek(0)
+                buffer.truncate()
+        yield buffer.getvalue()
+    elif fmt == 'json':
+        yield '['
+        for count, (monitor_id, config, running) in enumerate(rows):
+            yield (',' if count else '') + json.dumps({'id': monitor_id, **config, 'running': running})
+        yield ']\n'
+    else:
+        raise BulkError(f"Unknown format {fmt!r}; use csv or json")
+
+
+def _format_for(path, fmt):
+    if fmt:
+        return fmt
+    return 'json' if path.lower().endswith('.json') else 'csv'
+
+
+def main():
+    import requests
+
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--server', default=os.environ.get('MONITOR_SERVER', 'http://127.0.0.1:5000'))
+    parser.add_argument('--token', default=os.environ.get('ADMIN_TOKEN'), help='the server\'s ADMIN_TOKEN')
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    importer = commands.add_parser('import', help='create monitors from a CSV or JSON file ("-" for stdin)')
+    importer.add_argument('file')
+    importer.add_argument('--format', choices=('csv', 'json'), help='default: from the file extension')
+    importer.add_argument('--bot-token', help='for rows without one')
+    importer.add_argument('--chat-id', help='for rows without one')
+    importer.add_argument('--interval', type=int, help='check_interval for rows without one')
+    importer.add_argument('--start', action='store_true', help='start monitors whose row doesn\'t say')
+
+    exporter = commands.add_parser('export', help='write every monitor to stdout')
+    exporter.add_argument('--format', choices=('csv', 'json'), default='csv')
+    args = parser.parse_args()
+
+    headers = {'Authorization': f"Bearer {args.token}"} if args.token else {}
+    base = args.server.rstrip('/') + '/api/monitors'
+    if args.command == 'export':
+        with requests.get(f"{base}/export", params={'format': args.format}, headers=headers, stream=True) as response:
+            response.raise_for_status()
+            for chunk in response.iter_content(65536, decode_unicode=True):
+                sys.stdout.write(chunk)
+        return 0
+
+    data = sys.stdin.read() if args.file == '-' else open(args.file, encoding='utf-8-sig').read()
+    fmt = _format_for(args.file, args.format)
+    params = {'bot_token': args.bot_token, 'chat_id': args.chat_id, 'check_interval': args.interval,
+              'start': '1' if args.start else None}
+    response = requests.post(f"{base}/import", params={k: v for k, v in params.items() if v is not None},
+                             data=data.encode(), headers={**headers, 'Content-Type': f"text/{fmt}"
+                                                          if fmt == 'csv' else 'application/json'})
+    try:
+        result = response.json()
+    except ValueError:
+        response.raise_for_status()
+        raise
+    for error in result.get('errors', [])[:50]:
+        print(f"row {error['row']}: {error['error']}", file=sys.stderr)
+    if response.ok:
+        print(f"Created {result['created']} monitors, skipped {result['duplicates']} duplicates")
+    else:
+        print(result.get('error') or f"Import failed with {response.status_code}", file=sys.stderr)
+    return 0 if response.ok else 1
+
+
+if __name__ == '__main__':
+    sys.exit(main())
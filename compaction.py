@@ -0,0 +1,222 @@
+import logging
+import os
+import socket
+import threading
+from datetime import datetime, timedelta
+
+from database import db
+from lifecycle import STORAGE, on_shutdown
+
+
+class RetentionPolicy:
+    """How long each level of history is kept, in days"""
+
+    def __init__(self, raw_days=1, hourly_days=30, daily_days=365, log_days=14):
+        self.raw_days = raw_days  # raw checks and routine log lines
+        self.hourly_days = hourly_days  # hourly buckets, then rolled into days
+        self.daily_days = daily_days  # daily buckets and state transitions
+        self.log_days = log_days  # all other log entries
+
+    @classmethod
+    def from_env(cls):
+        """Build a policy from HISTORY_*_DAYS environment variables"""
+        return cls(
+            raw_days=float(os.environ.get('HISTORY_RAW_DAYS', 1)),
+            hourly_days=float(os.environ.get('HISTORY_HOURLY_DAYS', 30)),
+            daily_days=float(os.environ.get('HISTORY_DAILY_DAYS', 365)),
+            log_days=float(os.environ.get('HISTORY_LOG_DAYS', 14))
+        )
+
+
+def check_state(available):
+    """Map a CheckResult.available value to a transition state"""
+    if available is None:
+        return 'error'
+    return 'open' if available else 'full'
+
+
+def bucket_start(timestamp, period):
+    """Start of the hour or day containing timestamp"""
+    if period == 'day':
+        return timestamp.replace(hour=0, minute=0, second=0, microsecond=0)
+    return timestamp.replace(minute=0, second=0, microsecond=0)
+
+
+class Compactor:
+    """Background job that folds raw history into transitions and time buckets
+
+    Raw CheckResult rows older than the raw retention are collapsed into
+    StateTransition runs and hourly CheckAggregate buckets, then deleted.
+    Hourly buckets past their retention are rolled into daily buckets, and
+    daily buckets, transitions and log entries past theirs are dropped.
+
+    Every web worker and shard may start one; a JobLease makes sure only
+    one of them compacts at a time, and the same one keeps doing it.
+    """
+
+    LEASE = 'compaction'
+
+
+    def __init__(self, app, policy=None, interval=3600, batch_size=5000):
+        self.app = app
+        self.policy = policy or RetentionPolicy.from_env()
+        self.interval = interval
+        self.batch_size = batch_size
+        self.thread = None
+        self.owner = None  # lease owner id, set by the thread
+        self._stopping = threading.Event()
+        self._lock = threading.Lock()
+        on_shutdown(STORAGE, 'compactor', self.stop)
+
+    def is_running(self):
+        """Check if the compaction thread is alive"""
+        return self.thread is not None and self.thread.is_alive()
+
+    def start(self):
+        """Run compaction every interval seconds in a background thread"""
+        with self._lock:
+            if self.is_running():
+                return False
+            self._stopping.clear()
+            self.thread = threading.Thread(target=self._run, daemon=True, name='compactor')
+            self.thread.start()
+            return True
+
+    def stop(self, timeout=5):
+        """Stop after the current pass"""
+        with self._lock:
+            if not self.is_running():
+                return False
+            self._stopping.set()
+        self.thread.join(timeout=timeout)
+        from models import JobLease
+        try:
+            with self.app.app_context():
+                JobLease.release(self.LEASE, self.owner)
+        except Exception as e:
+            logging.warning(f"Releasing the compaction lease failed: {e}")
+        return True
+
+    def _run(self):
+        from models import JobLease
+
+        self.owner = f"{socket.gethostname()}:{os.getpid()}"
+        # Held a while past the next pass, so the holder renews it before anyone else can claim it
+        lease = timedelta(seconds=self.interval * 1.5)
+        while not self._stopping.wait(self.interval):
+            try:
+                with self.app.app_context():
+                    if JobLease.acquire(self.LEASE, self.owner, lease):
+                        self.run_once()
+            except Exception as e:
+                logging.error(f"Compaction failed: {e}")
+                with self.app.app_context():
+                    db.session.rollback()
+
+    def run_once(self, now=None):
+        """Run every compaction step once; needs an app context"""
+        now = now or datetime.utcnow()
+        policy = self.policy
+        raw_cutoff = now - timedelta(days=policy.raw_days)
+
+        checks = 0
+        while not self._stopping.is_set():
+            compacted = self._compact_checks(raw_cutoff)
+            checks += compacted
+            if compacted < self.batch_size:
+                break
+        hours = self._rollup_hours(now - timedelta(days=policy.hourly_days))
+        expired = self._expire(now - timedelta(days=policy.daily_days), raw_cutoff, now - timedelta(days=policy.log_days))
+        logging.info(f"Compaction folded {checks} checks and {hours} hourly buckets, expired {expired} rows")
+        return checks, hours, expired
+
+    def _compact_checks(self, cutoff):
+        """Fold one batch of raw checks into transitions and hourly buckets"""
+        from models import CheckAggregate, CheckResult, StateTransition
+
+        rows = (CheckResult.query
+                .filter(CheckResult.timestamp < cutoff)
+                .order_by(CheckResult.testflight_url, CheckResult.timestamp, CheckResult.id)
+                .limit(self.batch_size)
+                .all())
+        if not rows:
+            return 0
+
+        transitions = {}
+        buckets = {}
+        for row in rows:
+            state = check_state(row.available)
+
+            run = transitions.get(row.testflight_url)
+            if run is None:
+                run = StateTransition.latest(row.testflight_url)
+            if run is not None and run.state == state and run.ended_at <= row.timestamp:
+                run.ended_at = row.timestamp
+                run.count += 1
+            else:
+                run = StateTransition(testflight_url=row.testflight_url, state=state,
+                                      started_at=row.timestamp, ended_at=row.timestamp, count=1)
+                db.session.add(run)
+            transitions[row.testflight_url] = run
+
+            key = (row.testflight_url, bucket_start(row.timestamp, 'hour'))
+            if key not in buckets:
+                buckets[key] = self._get_bucket(CheckAggregate, key[0], 'hour', key[1])
+            buckets[key].merge(1, state == 'open', state == 'full', state == 'error')
+
+        CheckResult.query.filter(CheckResult.id.in_([row.id for row in rows])).delete(synchronize_session=False)
+        db.session.commit()
+        return len(rows)
+
+    def _rollup_hours(self, cutoff):
+        """Merge hourly buckets older than cutoff into daily buckets"""
+        from models import CheckAggregate
+
+        total = 0
+        while not self._stopping.is_set():
+            hours = (CheckAggregate.query
+                     .filter(CheckAggregate.period == 'hour', CheckAggregate.bucket_start < cutoff)
+                     .limit(self.batch_size)
+                     .all())
+            if not hours:
+                break
+
+            days = {}
+            for hour in hours:
+                key = (hour.testflight_url, bucket_start(hour.bucket_start, 'day'))
+                if key not in days:
+                    days[key] = self._get_bucket(CheckAggregate, key[0], 'day', key[1])
+                days[key].merge(hour.checks, hour.open_count, hour.full_count, hour.error_count)
+                db.session.delete(hour)
+            db.session.commit()
+            total += len(hours)
+        return total
+
+    def _expire(self, daily_cutoff, raw_cutoff, log_cutoff):
+        """Delete rows that have aged out of every retention level"""
+        from models import CheckAggregate, MonitorLog, StateTransition
+        from monitor import ROUTINE_MESSAGES
+
+        expired = CheckAggregate.query.filter(
+            CheckAggregate.period == 'day', CheckAggregate.bucket_start < daily_cutoff
+        ).delete(synchronize_session=False)
+        expired += StateTransition.query.filter(
+            StateTransition.ended_at < daily_cutoff
+        ).delete(synchronize_session=False)
+        # Routine "still full" lines are redundant with transitions once compacted
+        expired += MonitorLog.query.filter(
+            MonitorLog.timestamp < raw_cutoff, MonitorLog.message.in_(ROUTINE_MESSAGES)
+        ).delete(synchronize_session=False)
+        expired += MonitorLog.query.filter(
+            MonitorLog.timestamp < log_cutoff
+        ).delete(synchronize_session=False)
+        db.session.commit()
+        return expired
+
+    def _get_bucket(self, model, testflight_url, period, start):
+        bucket = model.query.filter_by(testflight_url=testflight_url, period=period, bucket_start=start).first()
+        if bucket is None:
+            bucket = model(testflight_url=testflight_url, period=period, bucket_start=start,
+                           checks=0, open_count=0, full_count=0, error_count=0)
+            db.session.add(bucket)
+        return bucket
@@ -0,0 +1,61 @@
+import os
+import logging
+
+from flask_sqlalchemy import SQLAlchemy
+from sqlalchemy import event, inspect, text
+from sqlalchemy.orm import DeclarativeBase
+
+DEFAULT_DATABASE_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'testflight_monitor.db')
+
+
+class Base(DeclarativeBase):
+    pass
+
+
+db = SQLAlchemy(model_class=Base)
+
+
+def _set_sqlite_pragmas(dbapi_connection, connection_record):
+    """WAL lets dashboard reads run alongside the history writer"""
+    cursor = dbapi_connection.cursor()
+    cursor.execute("PRAGMA journal_mode=WAL")
+    # With WAL, NORMAL only syncs at checkpoints instead of on every commit
+    cursor.execute("PRAGMA synchronous=NORMAL")
+    cursor.execute("PRAGMA busy_timeout=5000")
+    cursor.close()
+
+
+def init_db(app):
+    """Bind the database to a Flask app and create or upgrade the schema"""
+    app.config.setdefault('SQLALCHEMY_DATABASE_URI', os.environ.get('DATABASE_URL', f'sqlite:///{DEFAULT_DATABASE_PATH}'))
+    app.config.setdefault('SQLALCHEMY_ENGINE_OPTIONS', {'pool_recycle': 300, 'pool_pre_ping': True})
+    db.init_app(app)
+
+    with app.app_context():
+        import models  # noqa: F401  (registers the tables)
+
+        if db.engine.dialect.name == 'sqlite':
+            event.listen(db.engine, 'connect', _set_sqlite_pragmas)
+        # Connections must not be shared with a forked child (gunicorn preload_app)
+        engine = db.engine
+        os.register_at_fork(after_in_child=lambda: engine.dispose(close=False))
+        db.create_all()
+        upgrade_schema()
+
+
+def upgrade_schema():
+    """Add columns and indexes introduced after a table was first created"""
+    inspector = inspect(db.engine)
+    with db.engine.begin() as connection:
+        for table in db.metadata.sorted_tables:
+            if not inspector.has_table(table.name):
+                continue
+            existing = {column['name'] for column in inspector.get_columns(table.name)}
+            for column in table.columns:
+                if column.name in existing:
+                    continue
+                column_type = column.type.compile(dialect=db.engine.dialect)
+                logging.info(f"Adding column {table.name}.{column.name}")
+                connection.execute(text(f'ALTER TABLE {table.name} ADD COLUMN {column.name} {column_type}'))
+            for index in table.indexes:
+                index.create(bind=connection, checkfirst=True)
@@ -0,0 +1,91 @@
+import re
+
+# Phrases on a TestFlight page that mean the beta is full
+FULL_INDICATORS = [
+    "This beta is full.",
+    "This beta isn't accepting any new testers right now.",
+    "beta is full",
+    "not accepting"
+]
+
+# Phrases that only appear on a page with open slots; seeing one ends the scan
+# early instead of reading to the end of the page to rule out the above. Only
+# add phrases checked against pages captured from Apple: a wrong one turns a
+# full page into a false alert. None are verified yet, so open pages are read
+# to the end.
+OPEN_INDICATORS = []
+
+# Apple serves the apostrophe in several encodings
+APOSTROPHE = "(?:'|’|&#39;|&#x27;|&apos;)"
+
+
+class Detector:
+    """Strategy interface for deciding slot availability from a page"""
+
+    def check_response(self, response):
+        """Return True if slots are available"""
+        raise NotImplementedError
+
+
+class FullPageDetector(Detector):
+    """Single-pass, case-insensitive matcher for "beta is full" indicators
+
+    A full indicator anywhere on the page means full, and the scan stops
+    there. A page with none counts as open, as it always has; an open
+    indicator (see OPEN_INDICATORS) ends the scan early with that verdict.
+    """
+
+    def __init__(self, indicators=FULL_INDICATORS, chunk_size=8192, open_indicators=OPEN_INDICATORS):
+        self.indicators = list(indicators)
+        self.open_indicators = list(open_indicators)
+        self.chunk_size = chunk_size
+        groups = [f"(?P<full>{self._alternatives(self.indicators)})"]
+        if self.open_indicators:
+            groups.append(f"(?P<open>{self._alternatives(self.open_indicators)})")
+        self.pattern = re.compile('|'.join(groups), re.IGNORECASE)
+        # Enough trailing text to catch an entity-encoded indicator split across chunks
+        self.overlap = max(len(i) for i in self.indicators + self.open_indicators) + 8
+
+    @staticmethod
+    def _alternatives(indicators):
+        # Longest first so overlapping phrases report the most specific match
+        return '|'.join(re.escape(i).replace("'", APOSTROPHE) for i in sorted(indicators, key=len, reverse=True))
+
+    def is_full(self, text):
+        """Check a complete page"""
+        return self.scan([text])
+
+    def scan(self, chunks):
+        """Check decoded chunks; True at the first full indicator, False at an open one or the end"""
+        tail = ''
+        for chunk in chunks:
+            window = tail + chunk
+            match = self.pattern.search(window)
+            if match:
+                return match.lastgroup == 'full'
+            tail = window[-self.overlap:]
+        return False
+
+    def check_response(self, response):
+        """Return True if slots are available, reading only as much body as needed"""
+        if response.encoding is None:
+            response.encoding = 'utf-8'
+        return not self.scan(response.iter_content(self.chunk_size, decode_unicode=True))
+
+
+DEFAULT_DETECTOR = FullPageDetector()
+
+# Indicator sets by page locale; register more with register_detector
+DETECTORS = {
+    'en': DEFAULT_DETECTOR
+}
+
+
+def register_detector(locale, detector):
+    """Make a detector available for monitors configured with locale"""
+    DETECTORS[locale] = detector
+
+
+def get_detector(locale=None):
+    """Get the detector for locale, falling back to English"""
+    return DETECTORS.get(locale or 'en', DEFAULT_DETECTOR)
@@ -0,0 +1,238 @@
+import asyncio
+import logging
+import os
+import random
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from lifecycle import POLLING, on_shutdown, stopping
+from metrics import POLL_RATE, REGISTRY
+
+
+class AdaptiveSchedule:
+    """Decides how long a target waits before its next poll
+
+    Errors back off exponentially from the base interval with full jitter,
+    honouring any Retry-After from the server. After the result flips
+    (full to open or back) the next burst_checks polls use burst_interval
+    so the change is confirmed and followed quickly. Every delay gets a
+    little jitter so targets with equal intervals drift apart.
+    """
+
+    def __init__(self, interval, burst_interval=None, burst_checks=5, max_backoff=900, jitter=0.1):
+        self.interval = interval
+        self.burst_interval = burst_interval
+        self.burst_checks = burst_checks
+        self.max_backoff = max_backoff
+        self.jitter = jitter
+        self.errors = 0
+        self.retry_after = None
+        self.burst_remaining = 0
+        self.last_result = None
+
+    def record_result(self, result):
+        """Note a successful check"""
+        if self.last_result is not None and result != self.last_result:
+            self.burst_remaining = self.burst_checks
+        self.last_result = result
+        self.errors = 0
+        self.retry_after = None
+
+    def record_error(self, retry_after=None):
+        """Note a failed check; retry_after comes from a 429/503 response"""
+        self.errors += 1
+        self.retry_after = retry_after
+
+    def shortest_delay(self):
+        """Smallest delay next_delay gives without errors, before jitter"""
+        return min(self.burst_interval or max(5, self.interval / 4), self.interval)
+
+    def first_delay(self):
+        """Random phase within one interval, for spreading many starts"""
+        return random.uniform(0, self.interval)
+
+    def next_delay(self):
+        """Seconds until the next poll"""
+        if self.errors:
+            ceiling = min(self.max_backoff, self.interval * 2 ** self.errors)
+            delay = random.uniform(self.interval, max(self.interval, ceiling))
+            if self.retry_after:
+                delay = max(delay, self.retry_after)
+            return delay
+        if self.burst_remaining:
+            self.burst_remaining -= 1
+            delay = self.shortest_delay()
+        else:
+            delay = self.interval
+        return delay * random.uniform(1 - self.jitter, 1 + self.jitter)
+
+
+class PollTarget:
+    """A single URL polled by the engine"""
+
+    def __init__(self, key, check, schedule):
+        self.key = key
+        self.check = check  # blocking callable run on the engine's executor
+        self.schedule = schedule
+        self.task = None
+
+
+class PollingEngine:
+    """Asyncio scheduler that polls many targets with a global concurrency cap"""
+
+    def __init__(self, max_concurrency=20):
+        self.max_concurrency = max_concurrency
+        self.loop = None
+        self.thread = None
+        self.targets = {}
+        self.waiting = 0  # targets due for a poll but held back by the concurrency cap
+        self.in_flight = 0  # checks running on the executor
+        self._semaphore = None
+        self._executor = None
+        self._lock = threading.Lock()
+        self._idle = threading.Condition()
+
+    def is_running(self):
+        """Check if the event loop thread is alive"""
+        return self.thread is not None and self.thread.is_alive()
+
+    def start(self):
+        """Start the event loop in a background thread"""
+        with self._lock:
+            if self.is_running():
+                return False
+
+            self._executor = ThreadPoolExecutor(max_workers=self.max_concurrency, thread_name_prefix='poll')
+            self.loop = asyncio.new_event_loop()
+            self._semaphore = asyncio.Semaphore(self.max_concurrency)
+            self.thread = threading.Thread(target=self._run_loop, daemon=True, name='polling-engine')
+            self.thread.start()
+            return True
+
+    def shutdown(self, timeout=5):
+        """Stop polling, then give checks already running up to timeout seconds to finish
+
+        Returns False if the engine wasn't running.
+        """
+        with self._lock:
+            if not self.is_running():
+                return False
+            self.targets.clear()
+            self.loop.call_soon_threadsafe(self._stop_loop)
+        deadline = time.monotonic() + timeout
+        self.thread.join(timeout)
+        with self._idle:
+            if not self._idle.wait_for(lambda: self.in_flight == 0, max(0.0, deadline - time.monotonic())):
+                logging.warning("Polling stopped with %d checks still running", self.in_flight)
+        self._executor.shutdown(wait=False)
+        return True
+
+    def add_target(self, target, stagger=False):
+        """Schedule a target; returns False if the key is already scheduled
+
+        With stagger the first poll lands at a random point within one
+        interval, so targets added in bulk don't hit the host in lockstep.
+        Refused once the process is shutting down.
+        """
+        if stopping.is_set():
+            return False
+        self.start()
+        with self._lock:
+            if target.key in self.targets:
+                return False
+            self.targets[target.key] = target
+            delay = target.schedule.first_delay() if stagger else 0
+            self.loop.call_soon_threadsafe(self._spawn, target, delay)
+        return True
+
+    def remove_target(self, key):
+        """Unschedule a target; safe to call from any thread"""
+        with self._lock:
+            target = self.targets.pop(key, None)
+            if target is None:
+                return False
+            self.loop.call_soon_threadsafe(self._cancel, target)
+        return True
+
+    def has_target(self, key):
+        """Check if a target is currently scheduled"""
+        return key in self.targets
+
+    def get_stats(self):
+        """Target count and how busy the concurrency cap is"""
+        return {
+            'targets': len(self.targets),
+            'waiting': self.waiting,
+            'in_flight': self.in_flight,
+            'max_concurrency': self.max_concurrency
+        }
+
+    def _run_loop(self):
+        asyncio.set_event_loop(self.loop)
+        logging.info(f"Polling engine started (max concurrency {self.max_concurrency})")
+        self.loop.run_forever()
+        self.loop.close()
+        logging.info("Polling engine stopped")
+
+    def _stop_loop(self):
+        tasks = asyncio.all_tasks(self.loop)
+        for task in tasks:
+            task.cancel()
+        if not tasks:
+            self.loop.stop()
+            return
+        # Let the cancellations run before stopping so no task is left pending
+        self.loop.create_task(asyncio.wait(tasks)).add_done_callback(lambda _: self.loop.stop())
+
+    def _spawn(self, target, delay):
+        target.task = self.loop.create_task(self._run_target(target, delay))
+
+    def _cancel(self, target):
+        if target.task:
+            target.task.cancel()
+
+    async def _run_target(self, target, delay):
+        """Poll one target forever, sharing the global concurrency cap"""
+        if delay:
+            await asyncio.sleep(delay)
+        while True:
+            self.waiting += 1
+            try:
+                await self._semaphore.acquire()
+            finally:
+                self.waiting -= 1
+            try:
+                await self.loop.run_in_executor(self._executor, self._check, target)
+            except Exception as e:
+                logging.error("Unhandled error polling: %s", e, extra={'monitor': target.key})
+            finally:
+                self._semaphore.release()
+                POLL_RATE.mark()
+            await asyncio.sleep(target.schedule.next_delay())
+
+    def _check(self, target):
+        """Run one check on an executor thread, counted so shutdown can wait for it"""
+        with self._idle:
+            self.in_flight += 1
+        try:
+            target.check()
+        finally:
+            with self._idle:
+                self.in_flight -= 1
+                self._idle.notify_all()
+
+
+_engine = None
+_engine_lock = threading.Lock()
+
+
+def get_engine():
+    """Get the process-wide polling engine"""
+    global _engine
+    with _engine_lock:
+        if _engine is None:
+            _engine = PollingEngine(int(os.environ.get('MONITOR_MAX_CONCURRENCY', 20)))
+            REGISTRY.register_stats('polling_engine', _engine.get_stats)
+            on_shutdown(POLLING, 'polling engine', _engine.shutdown)
+        return _engine
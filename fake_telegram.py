@@ -0,0 +1,122 @@
+import json
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+
+class FakeTelegramServer:
+    """Local stand-in for api.telegram.org that records sendMessage calls
+
+    Point an AlertDispatcher at server.url (or set TELEGRAM_API_BASE) and
+    inspect server.messages. Set rate_limit_next to answer that many
+    requests with a 429 and retry_after, or fail_next to answer with a 500.
+    rate_limit_after lets that many requests through before the 429s start.
+    """
+
+    def __init__(self, host='127.0.0.1', port=0, latency=0.0):
+        self.latency = latency
+        self.retry_after = 1
+        self.rate_limit_next = 0
+        self.rate_limit_after = 0
+        self.fail_next = 0
+        self.messages = []  # dicts with bot_token, chat_id, text, parse_mode, received_at
+        self.requests = 0
+        self._lock = threading.Lock()
+        self.httpd = ThreadingHTTPServer((host, port), self._make_handler())
+        self.httpd.daemon_threads = True
+        self.thread = None
+
+    @property
+    def url(self):
+        host, port = self.httpd.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def start(self):
+        self.thread = threading.Thread(target=self.httpd.serve_forever, daemon=True, name='fake-telegram')
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.stop()
+
+    def _respond(self, handler, bot_token, fields):
+        if self.latency:
+            time.sleep(self.latency)
+        with self._lock:
+            self.requests += 1
+            if self.rate_limit_next > 0 and self.rate_limit_after > 0:
+                self.rate_limit_after -= 1
+            elif self.rate_limit_next > 0:
+                self.rate_limit_next -= 1
+                return 429, {'ok': False, 'error_code': 429,
+                             'description': f'Too Many Requests: retry after {self.retry_after}',
+                             'parameters': {'retry_after': self.retry_after}}
+            if self.fail_next > 0:
+                self.fail_next -= 1
+                return 500, {'ok': False, 'error_code': 500, 'description': 'Internal Server Error'}
+            if 'chat_id' not in fields or 'text' not in fields:
+                return 400, {'ok': False, 'error_code': 400, 'description': 'Bad Request: message text is empty'}
+            self.messages.append({
+                'bot_token': bot_token,
+                'chat_id': str(fields['chat_id']),
+                'text': fields['text'],
+                'parse_mode': fields.get('parse_mode'),
+                'received_at': time.time()
+            })
+            return 200, {'ok': True, 'result': {'message_id': len(self.messages), 'text': fields['text']}}
+
+    def _make_handler(self):
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def do_GET(self):
+                url = urlparse(self.path)
+                fields = {k: v[0] for k, v in parse_qs(url.query).items()}
+                self._dispatch(url.path, fields)
+
+            def do_POST(self):
+                length = int(self.headers.get('Content-Length', 0))
+                body = self.rfile.read(length) if length else b''
+                if self.headers.get('Content-Type', '').startswith('application/json'):
+                    fields = json.loads(body or b'{}')
+                else:
+                    fields = {k: v[0] for k, v in parse_qs(body.decode()).items()}
+                self._dispatch(urlparse(self.path).path, fields)
+
+            def _dispatch(self, path, fields):
+                prefix, _, method = path.rpartition('/')
+                if not prefix.startswith('/bot') or method != 'sendMessage':
+                    status, payload = 404, {'ok': False, 'error_code': 404, 'description': 'Not Found'}
+                else:
+                    status, payload = server._respond(self, prefix[len('/bot'):], fields)
+                body = json.dumps(payload).encode()
+                self.send_response(status)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        return Handler
+
+
+if __name__ == '__main__':
+    with FakeTelegramServer(port=8081) as fake:
+        print(f"Fake Telegram API listening on {fake.url}")
+        try:
+            while True:
+                time.sleep(1)
+        except KeyboardInterrupt:
+            pass
@@ -0,0 +1,152 @@
+import random
+import sys
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+FULL_TEXT = "This beta is full."
+OPEN_TEXT = "To join the beta, open the link on your iPhone, iPad or Mac."
+FILLER = "<p>Lorem ipsum dolor sit amet, consectetur adipiscing elit.</p>\n"
+
+
+class _Server(ThreadingHTTPServer):
+    daemon_threads = True
+    request_queue_size = 1024
+
+    def handle_error(self, request, client_address):
+        # Monitors close the connection once they have a verdict
+        if not isinstance(sys.exc_info()[1], ConnectionError):
+            super().handle_error(request, client_address)
+
+
+class FakeTestFlightServer:
+    """Local stand-in for testflight.apple.com join pages
+
+    Any path ending in /join/<code> serves that beta's page, full unless
+    set_open(code) was called. Pages are padded to page_size bytes with
+    the verdict text at the end, or verdict_offset bytes in to model a
+    page whose marker comes early. Each request waits latency seconds, and error_rate of them get
+    error_status with a Retry-After. ETags change with the page state so
+    conditional requests behave as they do against Apple.
+
+    The web form only accepts testflight.apple.com URLs, so url_for()
+    puts that host name in the path: http://127.0.0.1:<port>/testflight.apple.com/join/<code>.
+    """
+
+    def __init__(self, host='127.0.0.1', port=0, latency=0.0, error_rate=0.0, error_status=503,
+                 page_size=40000, etag=True, verdict_offset=None):
+        self.latency = latency
+        self.error_rate = error_rate
+        self.error_status = error_status
+        self.page_size = page_size
+        self.etag = etag
+        self.verdict_offset = verdict_offset
+        self.open_codes = set()
+        self.opened_at = {}  # code -> time.time() when it was opened
+        self.requests = 0
+        self.errors = 0
+        self.not_modified = 0
+        self._pages = {}  # (code, is_open) -> body
+        self._lock = threading.Lock()
+        self.httpd = _Server((host, port), self._make_handler())
+        self.thread = None
+
+    @property
+    def url(self):
+        host, port = self.httpd.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def url_for(self, code):
+        return f"{self.url}/testflight.apple.com/join/{code}"
+
+    def set_open(self, code, is_open=True):
+        """Open (or fill) a beta; records when it opened"""
+        with self._lock:
+            if is_open:
+                self.open_codes.add(code)
+                self.opened_at[code] = time.time()
+            else:
+                self.open_codes.discard(code)
+
+    def start(self):
+        self.thread = threading.Thread(target=self.httpd.serve_forever, daemon=True, name='fake-testflight')
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.stop()
+
+    def page(self, code, is_open):
+        key = (code, is_open)
+        body = self._pages.get(key)
+        if body is None:
+            head = f"<!DOCTYPE html><html><head><title>Join the {code} beta - TestFlight - Apple</title></head><body>\n"
+            verdict = f"<div class=\"beta-status\">{OPEN_TEXT if is_open else FULL_TEXT}</div>\n"
+            tail = "</body></html>\n"
+            filler = max(0, self.page_size - len(head) - len(verdict) - len(tail))
+            padding = (FILLER * (filler // len(FILLER) + 1))[:filler]
+            split = filler if self.verdict_offset is None else min(filler, max(0, self.verdict_offset - len(head)))
+            body = head + padding[:split] + verdict + padding[split:] + tail
+            body = self._pages[key] = body.encode()
+        return body
+
+    def _respond(self, path, headers):
+        if self.latency:
+            time.sleep(self.latency)
+        prefix, _, code = path.rstrip('/').rpartition('/')
+        if not prefix.endswith('/join') or not code:
+            return 404, {}, b'Not Found'
+
+        with self._lock:
+            self.requests += 1
+            if self.error_rate and random.random() < self.error_rate:
+                self.errors += 1
+                return self.error_status, {'Retry-After': '1'}, b''
+            is_open = code in self.open_codes
+
+        response_headers = {'Content-Type': 'text/html; charset=utf-8'}
+        if self.etag:
+            etag = f'"{code}-{"open" if is_open else "full"}"'
+            response_headers['ETag'] = etag
+            if headers.get('If-None-Match') == etag:
+                with self._lock:
+                    self.not_modified += 1
+                return 304, response_headers, b''
+        return 200, response_headers, self.page(code, is_open)
+
+    def _make_handler(self):
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def do_GET(self):
+                status, headers, body = server._respond(self.path.split('?')[0], self.headers)
+                self.send_response(status)
+                for name, value in headers.items():
+                    self.send_header(name, value)
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        return Handler
+
+
+if __name__ == '__main__':
+    with FakeTestFlightServer(port=8082) as fake:
+        print(f"Fake TestFlight listening on {fake.url}; pages at {fake.url_for('<code>')}")
+        try:
+            while True:
+                time.sleep(1)
+        except KeyboardInterrupt:
+            pass
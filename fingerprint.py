@@ -0,0 +1,10 @@
+import hashlib
+
+
+def fingerprint(data):
+    """Short digest of page bytes, to tell whether a page changed between fetches
+
+    Bytes are hashed as they are. Blanking nonces and tokens first took a
+    regex pass costing many times the detection it was meant to skip.
+    """
+    return hashlib.blake2b(data, digest_size=16).digest()
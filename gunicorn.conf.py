@@ -0,0 +1,70 @@
+# Loaded automatically by gunicorn from the working directory
+import multiprocessing.process
+import os
+import signal
+
+import lifecycle
+from workers import WorkerPool, worker_count
+
+bind = "0.0.0.0:5000"
+# Threaded workers: dashboard event streams and long-polls each hold a
+# thread, so a sync worker would block every other request behind one.
+# api.py keeps MONITOR_MAX_STREAMS (8) of them per worker.
+worker_class = "gthread"
+threads = int(os.environ.get('GUNICORN_THREADS', 16))
+# Time a worker gets to drain alerts and history after SIGTERM (rolling restarts)
+graceful_timeout = 30
+
+# Import the app once in the master and fork workers that are ready at once;
+# each starts its threads and monitors in post_worker_init. MONITOR_PRELOAD=0
+# imports the app in every worker instead.
+preload_app = os.environ.get('MONITOR_PRELOAD', '1') != '0'
+lifecycle.preforking = preload_app
+
+_pool = None
+
+
+def on_starting(server):
+    """With MONITOR_WORKERS set, run monitors in dedicated shard processes"""
+    global _pool
+    if worker_count():
+        _pool = WorkerPool(worker_count())
+        _pool.start()
+        server.log.info(f"Started {worker_count()} monitor shard processes")
+
+
+def post_fork(server, worker):
+    """Forget the shard processes inherited from the master
+
+    They're the master's children; left in the worker's multiprocessing
+    table, its exit handler would try to join them and fail.
+    """
+    multiprocessing.process._children.clear()
+
+
+def post_worker_init(worker):
+    """Start the worker's monitors and mark it stopping as soon as SIGTERM arrives
+
+    gunicorn's own handler only stops accepting requests; setting
+    lifecycle.stopping also ends open event streams and long-polls so the
+    worker can exit within graceful_timeout.
+    """
+    lifecycle.startup()
+    previous = signal.getsignal(signal.SIGTERM)
+
+    def handle_term(signum, frame):
+        lifecycle.stopping.set()
+        if callable(previous):
+            previous(signum, frame)
+
+    signal.signal(signal.SIGTERM, handle_term)
+
+
+def worker_exit(server, worker):
+    """Finish in-flight checks, deliver queued alerts and flush history"""
+    lifecycle.shutdown()
+
+
+def on_exit(server):
+    if _pool:
+        _pool.stop()
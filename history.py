@@ -0,0 +1,123 @@
+import logging
+import queue
+import threading
+import time
+from datetime import datetime
+
+from database import db
+from lifecycle import STORAGE, on_shutdown
+from metrics import REGISTRY
+
+
+class HistoryWriter:
+    """Queues log and check rows in memory and writes them in batched transactions"""
+
+    def __init__(self, app, batch_size=500, flush_interval=2.0, max_queue=100000):
+        self.app = app
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.queue = queue.Queue(max_queue)
+        self.thread = None
+        self.written = 0
+        self.failed = 0
+        self.dropped = 0
+        self._stopping = threading.Event()
+        self._lock = threading.Lock()
+        REGISTRY.register_stats('history_writer', self.get_stats, counters=('written', 'failed', 'dropped'))
+        on_shutdown(STORAGE, 'history writer', self.stop)
+
+    def is_running(self):
+        """Check if the writer thread is alive"""
+        return self.thread is not None and self.thread.is_alive()
+
+    def start(self):
+        """Start the background writer"""
+        with self._lock:
+            if self.is_running():
+                return False
+            self._stopping.clear()
+            self.thread = threading.Thread(target=self._run, daemon=True, name='history-writer')
+            self.thread.start()
+            return True
+
+    def stop(self, timeout=5):
+        """Flush queued rows and stop the writer"""
+        with self._lock:
+            if not self.is_running():
+                return False
+            self._stopping.set()
+        self.thread.join(timeout=timeout)
+        return True
+
+    def add_log(self, level, message, testflight_url=None, timestamp=None):
+        """Queue a MonitorLog row"""
+        self._put('log', {
+            'timestamp': timestamp or datetime.utcnow(),
+            'level': level,
+            'message': message,
+            'testflight_url': testflight_url
+        })
+
+    def add_check(self, testflight_url, available, error=None, timestamp=None):
+        """Queue a CheckResult row"""
+        self._put('check', {
+            'timestamp': timestamp or datetime.utcnow(),
+            'testflight_url': testflight_url,
+            'available': available,
+            'error': error
+        })
+
+    def get_stats(self):
+        """Queue depth and row counters"""
+        return {
+            'queued': self.queue.qsize(),
+            'written': self.written,
+            'failed': self.failed,
+            'dropped': self.dropped
+        }
+
+    def _put(self, kind, row):
+        if not self.is_running():
+            self.start()
+        try:
+            self.queue.put_nowait((kind, row))
+        except queue.Full:
+            # Never let persistence stall the polling path
+            self.dropped += 1
+
+    def _run(self):
+        while not (self._stopping.is_set() and self.queue.empty()):
+            batch = self._collect()
+            if batch:
+                self._flush(batch)
+
+    def _collect(self):
+        """Gather up to batch_size rows, waiting at most flush_interval"""
+        batch = []
+        deadline = time.monotonic() + self.flush_interval
+        while len(batch) < self.batch_size:
+            # When stopping, drain whatever is queued without waiting
+            remaining = 0 if self._stopping.is_set() else deadline - time.monotonic()
+            if remaining < 0:
+                break
+            try:
+                batch.append(self.queue.get(timeout=remaining))
+            except queue.Empty:
+                break
+        return batch
+
+    def _flush(self, batch):
+        from models import CheckResult, MonitorLog
+
+        logs = [row for kind, row in batch if kind == 'log']
+        checks = [row for kind, row in batch if kind == 'check']
+        try:
+            with self.app.app_context():
+                MonitorLog.bulk_insert(logs)
+                CheckResult.bulk_insert(checks)
+                db.session.commit()
+            self.written += len(batch)
+            logging.debug("History writer flushed %d logs and %d checks", len(logs), len(checks))
+        except Exception as e:
+            self.failed += len(batch)
+            logging.error("History writer failed to flush %d rows: %s", len(batch), e)
@@ -0,0 +1,665 @@
+import logging
+import os
+import socket
+import ssl
+import threading
+import time
+from concurrent.futures import Future
+from email.utils import parsedate_to_datetime
+
+import requests
+from requests.adapters import HTTPAdapter
+from requests.utils import DEFAULT_CA_BUNDLE_PATH, stream_decode_response_unicode
+from urllib3.connection import HTTPConnection, HTTPSConnection
+from urllib3.connectionpool import HTTPConnectionPool, HTTPSConnectionPool
+from urllib3.exceptions import ConnectTimeoutError, NameResolutionError, NewConnectionError
+
+from fingerprint import fingerprint
+from metrics import CHECK_PHASE_SECONDS, FETCHES, REGISTRY
+from records import now_ms
+from urls import normalize_url
+
+USER_AGENT = 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/91.0.4472.124 Safari/537.36'
+
+
+# Seconds spent per phase by the fetch running on this thread
+_phases = threading.local()
+
+
+def _add_phase(phase, seconds):
+    timings = getattr(_phases, 'timings', None)
+    if timings is not None:
+        timings[phase] = timings.get(phase, 0.0) + seconds
+
+
+class ResolverCache:
+    """getaddrinfo results kept for ttl seconds per (host, port)
+
+    getaddrinfo doesn't expose record TTLs, so ttl should be at or below
+    the real ones. An expired entry is re-resolved by the next connection
+    to need it; if that lookup fails the old addresses are used for up to
+    max_stale more seconds, so a resolver blip doesn't fail every check.
+    """
+
+    def __init__(self, ttl=60.0, max_stale=600.0):
+        self.ttl = ttl
+        self.max_stale = max_stale
+        self.entries = {}  # (host, port) -> (expires_at, addresses)
+        self.hits = 0
+        self.misses = 0
+        self.stale = 0
+        self._lock = threading.Lock()
+
+    def resolve(self, host, port):
+        """Addresses for host as getaddrinfo returns them; raises socket.gaierror"""
+        key = (host, port)
+        now = time.monotonic()
+        with self._lock:
+            entry = self.entries.get(key)
+            if entry and entry[0] > now:
+                self.hits += 1
+                return entry[1]
+        try:
+            addresses = socket.getaddrinfo(host, port, 0, socket.SOCK_STREAM)
+        except socket.gaierror:
+            if entry and entry[0] + self.max_stale > now:
+                with self._lock:
+                    self.stale += 1
+                logging.warning("Resolving %s failed; using addresses cached %.0fs ago",
+                                host, now - entry[0] + self.ttl)
+                return entry[1]
+            raise
+        with self._lock:
+            self.misses += 1
+            self.entries[key] = (time.monotonic() + self.ttl, addresses)
+        return addresses
+
+    def get_stats(self):
+        lookups = self.hits + self.misses + self.stale
+        return {'hits': self.hits, 'misses': self.misses, 'stale': self.stale,
+                'hit_rate': (self.hits + self.stale) / lookups if lookups else 0.0,
+                'entries': len(self.entries)}
+
+
+class TLSSessionCache:
+    """Last TLS session per server name, offered again on the next handshake
+
+    Resuming skips the certificate exchange and most of the handshake
+    work. Sessions are dropped once past their lifetime.
+    """
+
+    def __init__(self):
+        self.sessions = {}  # server_hostname -> ssl.SSLSession
+        self.resumed = 0
+        self.full = 0
+        self._lock = threading.Lock()
+
+    def get(self, server_hostname):
+        with self._lock:
+            session = self.sessions.get(server_hostname)
+            if session is not None and session.time + session.timeout <= time.time():
+                del self.sessions[server_hostname]
+                session = None
+            return session
+
+    def save(self, server_hostname, sock):
+        session = getattr(sock, 'session', None)
+        if session is not None:
+            with self._lock:
+                self.sessions[server_hostname] = session
+
+    def record(self, server_hostname, sock):
+        """Count a finished handshake and keep its session"""
+        with self._lock:
+            if sock.session_reused:
+                self.resumed += 1
+            else:
+                self.full += 1
+        self.save(server_hostname, sock)
+
+    def get_stats(self):
+        handshakes = self.resumed + self.full
+        return {'resumed': self.resumed, 'full': self.full,
+                'hit_rate': self.resumed / handshakes if handshakes else 0.0,
+                'entries': len(self.sessions)}
+
+
+class SessionReusingContext(ssl.SSLContext):
+    """SSLContext that resumes TLS sessions from its session_cache"""
+
+    session_cache = None
+
+    def wrap_socket(self, sock, *args, server_hostname=None, session=None, **kwargs):
+        cache = self.session_cache
+        if cache is not None and server_hostname and session is None:
+            session = cache.get(server_hostname)
+        ssock = super().wrap_socket(sock, *args, server_hostname=server_hostname, session=session, **kwargs)
+        if cache is not None and server_hostname:
+            cache.record(server_hostname, ssock)
+        return ssock
+
+
+def create_ssl_context(session_cache=None):
+    """Verifying client context with the CA bundle loaded once, instead of per connection
+
+    Settings follow urllib3's defaults: TLS 1.2 or newer, no compression.
+    """
+    context = SessionReusingContext(ssl.PROTOCOL_TLS_CLIENT)
+    context.minimum_version = ssl.TLSVersion.TLSv1_2
+    context.options |= ssl.OP_NO_COMPRESSION
+    context.load_verify_locations(DEFAULT_CA_BUNDLE_PATH)
+    context.session_cache = session_cache
+    return context
+
+
+class _TimedConnectionMixin:
+    """Times name resolution and the TCP connect of new pooled connections
+
+    Names are looked up through the process-wide ResolverCache.
+    """
+
+    def _new_conn(self):
+        host = self._dns_host
+        started = time.perf_counter()
+        try:
+            addresses = get_resolver().resolve(host, self.port)
+        except socket.gaierror as e:
+            raise NameResolutionError(self.host, self, e) from e
+        resolved = time.perf_counter()
+        _add_phase('dns', resolved - started)
+
+        try:
+            for index, (*_, sockaddr) in enumerate(addresses):
+                self._dns_host = sockaddr[0]  # connect to the address just resolved
+                try:
+                    sock = super()._new_conn()
+                    break
+                except (ConnectTimeoutError, NewConnectionError):
+                    if index == len(addresses) - 1:
+                        raise
+        finally:
+            self._dns_host = host
+        self._connected_at = time.perf_counter()
+        _add_phase('connect', self._connected_at - resolved)
+        return sock
+
+
+class TimedHTTPConnection(_TimedConnectionMixin, HTTPConnection):
+    pass
+
+
+class TimedHTTPSConnection(_TimedConnectionMixin, HTTPSConnection):
+    """Also times the TLS handshake that follows the TCP connect"""
+
+    def connect(self):
+        self._connected_at = None
+        super().connect()
+        if self._connected_at is not None:
+            _add_phase('tls', time.perf_counter() - self._connected_at)
+
+    def getresponse(self, *args, **kwargs):
+        # Taken first: on Connection: close http.client lets go of self.sock while reading the response
+        sock = self.sock
+        response = super().getresponse(*args, **kwargs)
+        # TLS 1.3 tickets arrive after the handshake; by now they've been read
+        cache = getattr(self.ssl_context, 'session_cache', None)
+        if cache is not None and sock is not None:
+            cache.save(self.server_hostname or self.host, sock)
+        return response
+
+
+class TimedHTTPConnectionPool(HTTPConnectionPool):
+    ConnectionCls = TimedHTTPConnection
+
+
+class TimedHTTPSConnectionPool(HTTPSConnectionPool):
+    ConnectionCls = TimedHTTPSConnection
+
+
+class TimedHTTPAdapter(HTTPAdapter):
+    """HTTPAdapter whose connections report dns, connect and tls timings
+
+    With an ssl_context (see create_ssl_context) every HTTPS connection
+    shares it, rather than building its own and loading certificates.
+    """
+
+    def __init__(self, *args, ssl_context=None, **kwargs):
+        self.ssl_context = ssl_context
+        super().__init__(*args, **kwargs)
+
+    def init_poolmanager(self, *args, **kwargs):
+        if self.ssl_context is not None:
+            kwargs['ssl_context'] = self.ssl_context
+        super().init_poolmanager(*args, **kwargs)
+        self.poolmanager.pool_classes_by_scheme = {'http': TimedHTTPConnectionPool, 'https': TimedHTTPSConnectionPool}
+
+    def cert_verify(self, conn, url, verify, cert):
+        super().cert_verify(conn, url, verify, cert)
+        if self.ssl_context is not None and verify is True:
+            conn.ca_certs = None  # already in ssl_context; don't reload it per connection
+
+
+def create_session(pool_size=20, ssl_context=None):
+    """Create a keep-alive session whose pool can hold pool_size connections per host"""
+    session = requests.Session()
+    adapter = TimedHTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size, ssl_context=ssl_context)
+    session.mount('https://', adapter)
+    session.mount('http://', adapter)
+    session.headers.update({
+        'User-Agent': USER_AGENT,
+        'Connection': 'keep-alive'
+    })
+    return session
+
+
+def parse_retry_after(response):
+    """Seconds from a Retry-After header (delta or HTTP date), or None"""
+    value = response.headers.get('Retry-After') if response is not None else None
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        return max(0.0, parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return None
+
+
+class FetchResult:
+    """Outcome of a conditional fetch; changed_at is when the page content last changed (epoch ms)"""
+
+    def __init__(self, value, not_modified, status_code, changed_at=None):
+        self.value = value
+        self.not_modified = not_modified
+        self.status_code = status_code
+        self.changed_at = changed_at
+
+
+class _CachedPage:
+    """What a fetcher remembers about a page between fetches"""
+
+    def __init__(self, etag, last_modified, value, fingerprint, length, complete, changed_at):
+        self.etag = etag
+        self.last_modified = last_modified
+        self.value = value
+        self.fingerprint = fingerprint  # of the first length bytes, the part parse read
+        self.length = length
+        self.complete = complete  # parse read the whole body
+        self.changed_at = changed_at
+
+
+class BodyTooLarge(requests.RequestException):
+    """The page went past the fetcher's byte budget without a verdict"""
+
+
+class _TimedBody:
+    """Response wrapper that adds up the time spent reading the body
+
+    Parsers stream the body through iter_content, so time inside the
+    iterator is download and the rest of parse() is parsing. Reading
+    more than max_bytes of decompressed body raises BodyTooLarge.
+
+    Bytes handed to the parser are kept in consumed for fingerprinting.
+    peek() reads ahead without consuming, so the fetcher can compare a
+    page with the last one before deciding whether to parse it.
+    """
+
+    def __init__(self, response, max_bytes=None):
+        self._response = response
+        self.max_bytes = max_bytes
+        self.seconds = 0.0
+        self.bytes = 0
+        self.exhausted = False
+        self.consumed = []
+        self._pending = []
+        self._chunks = None
+
+    def __getattr__(self, name):
+        return getattr(self._response, name)
+
+    def __setattr__(self, name, value):
+        if name in ('_response', 'max_bytes', 'seconds', 'bytes', 'exhausted', 'consumed', '_pending', '_chunks'):
+            object.__setattr__(self, name, value)
+        else:
+            setattr(self._response, name, value)
+
+    @property
+    def complete(self):
+        """Whether the parser was handed the whole body"""
+        return self.exhausted and not self._pending
+
+    def iter_content(self, chunk_size=1, decode_unicode=False):
+        chunks = self._consume(chunk_size)
+        if decode_unicode:
+            chunks = stream_decode_response_unicode(chunks, self._response)
+        return chunks
+
+    def peek(self, length, chunk_size=8192):
+        """Up to length bytes from the start of the body, left for iter_content to hand out"""
+        buffered = sum(len(chunk) for chunk in self._pending)
+        if buffered < length:
+            for chunk in self._source(chunk_size):
+                self._pending.append(chunk)
+                buffered += len(chunk)
+                if buffered >= length:
+                    break
+        return b''.join(self._pending)[:length]
+
+    def _consume(self, chunk_size):
+        source = self._source(chunk_size)
+        while self._pending:
+            chunk = self._pending.pop(0)
+            self.consumed.append(chunk)
+            yield chunk
+        for chunk in source:
+            self.consumed.append(chunk)
+            yield chunk
+
+    def _source(self, chunk_size):
+        if self._chunks is None:
+            self._chunks = self._read(chunk_size)
+        return self._chunks
+
+    def _read(self, chunk_size):
+        # urllib3 decompresses gzip/deflate a chunk at a time, so stopping
+        # early also stops decompressing
+        chunks = self._response.iter_content(chunk_size)
+        while True:
+            started = time.perf_counter()
+            try:
+                chunk = next(chunks)
+            except StopIteration:
+                self.exhausted = True
+                return
+            finally:
+                self.seconds += time.perf_counter() - started
+            self.bytes += len(chunk)
+            if self.max_bytes and self.bytes > self.max_bytes:
+                raise BodyTooLarge(f"No verdict in the first {self.max_bytes} bytes of {self._response.url}")
+            yield chunk
+
+
+class ConditionalFetcher:
+    """Fetches pages with If-None-Match/If-Modified-Since and caches the parsed value
+
+    When the server sends validators they also say when the page changed.
+    Servers that send none are covered by a content fingerprint: if parse
+    stopped part-way through the page last time, the bytes it read are
+    hashed, and when a new response starts with the same bytes the cached
+    value is reused without parsing. Either way the result says when the
+    content last changed.
+
+    Bodies are streamed: parse stops reading once it has a verdict, and
+    never reads more than max_bytes. Afterwards a remainder of up to
+    drain_bytes (on the wire) is read off so the connection goes back to
+    the pool; anything bigger closes it, which is cheaper than downloading
+    the rest of the page.
+    """
+
+    def __init__(self, session, max_bytes=1048576, drain_bytes=65536):
+        self.session = session
+        self.max_bytes = max_bytes
+        self.drain_bytes = drain_bytes
+        self.cache = {}  # (url, parse) -> _CachedPage
+        self.unchanged = 0
+        self.reused = 0
+        self.closed = 0
+        self.bytes_read = 0
+        self._lock = threading.Lock()
+
+    def fetch(self, url, parse, timeout=10):
+        """GET url and return parse(response), or the cached value on 304"""
+        key = (url, parse)
+        with self._lock:
+            cached = self.cache.get(key)
+
+        headers = {}
+        if cached:
+            if cached.etag:
+                headers['If-None-Match'] = cached.etag
+            if cached.last_modified:
+                headers['If-Modified-Since'] = cached.last_modified
+
+        _phases.timings = timings = {}
+        started = time.perf_counter()
+        try:
+            response = self.session.get(url, timeout=timeout, headers=headers, stream=True)
+        finally:
+            _phases.timings = None
+        FETCHES.inc(str(response.status_code))
+        # Whatever the connection phases didn't take was spent waiting for headers
+        download = time.perf_counter() - started - sum(timings.values())
+        try:
+            if response.status_code == 304 and cached:
+                logging.debug("Not modified: %s", url)
+                return FetchResult(cached.value, True, 304, cached.changed_at)
+
+            response.raise_for_status()
+            body = _TimedBody(response, self.max_bytes)
+            validators = (response.headers.get('ETag'), response.headers.get('Last-Modified'))
+            parse_started = time.perf_counter()
+            try:
+                if any(validators):
+                    # The server says when the page changes; nothing to hash
+                    value = parse(body)
+                    same = cached and (cached.etag, cached.last_modified) == validators
+                    cached = _CachedPage(None, None, value, None, 0, False, cached.changed_at if same else now_ms())
+                elif cached and cached.fingerprint and not cached.complete and self._same_content(body, cached):
+                    self.unchanged += 1
+                    value = cached.value
+                else:
+                    value = parse(body)
+                    page = b''.join(body.consumed)
+                    digest = fingerprint(page)
+                    same = cached and cached.fingerprint == digest
+                    cached = _CachedPage(None, None, value, digest, len(page), body.complete,
+                                         cached.changed_at if same else now_ms())
+            finally:
+                download += body.seconds
+                self.bytes_read += body.bytes
+            timings['parse'] = time.perf_counter() - parse_started - body.seconds
+        finally:
+            self._release(response)
+            timings['download'] = download
+            for phase, seconds in timings.items():
+                CHECK_PHASE_SECONDS.observe(seconds, phase)
+
+        cached.etag = response.headers.get('ETag')
+        cached.last_modified = response.headers.get('Last-Modified')
+        with self._lock:
+            self.cache[key] = cached
+        return FetchResult(value, False, response.status_code, cached.changed_at)
+
+    def forget(self, url, parse):
+        """Drop cached validators, e.g. when a monitor is removed"""
+        with self._lock:
+            self.cache.pop((url, parse), None)
+
+    def get_stats(self):
+        """Fingerprint hits, connection reuse and body bytes read"""
+        return {'unchanged': self.unchanged, 'reused': self.reused, 'closed': self.closed,
+                'bytes_read': self.bytes_read}
+
+    @staticmethod
+    def _same_content(body, cached):
+        """Whether body starts with the bytes parse read from cached's page"""
+        data = body.peek(cached.length)
+        return len(data) == cached.length and fingerprint(data) == cached.fingerprint
+
+    def _release(self, response):
+        """Return the connection to the pool if what's left of the body is small, else close it"""
+        raw = response.raw
+        try:
+            remaining = int(response.headers['Content-Length']) - raw.tell()
+        except (KeyError, ValueError):
+            remaining = None  # chunked: no telling how much is left
+        if raw.connection is None:
+            self.reused += 1  # body read to the end; urllib3 already released it
+        elif remaining is not None and remaining <= self.drain_bytes:
+            raw.drain_conn()
+            raw.release_conn()
+            self.reused += 1
+        else:
+            self.closed += 1
+        response.close()
+
+
+class SharedFetcher:
+    """Shares fetches of the same page between every monitor watching it
+
+    Keys are (normalized URL, parser). Concurrent requests for a key are
+    collapsed into one outbound fetch whose result (or error) all callers
+    receive, and successful results are served from a short-TTL cache, so
+    outbound load scales with unique URLs rather than subscribers. Callers
+    pass max_age to keep the cache from answering for their own previous
+    check.
+    """
+
+    def __init__(self, fetcher, ttl=5.0, max_entries=10000):
+        self.fetcher = fetcher
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.cache = {}  # key -> (fetched_at, FetchResult)
+        self.in_flight = {}  # key -> Future
+        self.subscribers = {}  # key -> number of running monitors watching it
+        self.hits = 0
+        self.misses = 0
+        self.coalesced = 0
+        self._lock = threading.Lock()
+
+    def fetch(self, url, parse, timeout=10, max_age=None):
+        """Fetch url through the cache; same return value as ConditionalFetcher.fetch
+
+        Cached results older than max_age seconds (or the TTL, if shorter)
+        aren't used.
+        """
+        key = (normalize_url(url), parse)
+        max_age = self.ttl if max_age is None else min(self.ttl, max_age)
+        with self._lock:
+            entry = self.cache.get(key)
+            if entry and time.monotonic() - entry[0] < max_age:
+                self.hits += 1
+                return entry[1]
+            future = self.in_flight.get(key)
+            leader = future is None
+            if leader:
+                future = self.in_flight[key] = Future()
+                self.misses += 1
+            else:
+                self.coalesced += 1
+
+        if not leader:
+            return future.result()
+
+        try:
+            result = self.fetcher.fetch(key[0], parse, timeout)
+        except BaseException as e:
+            with self._lock:
+                del self.in_flight[key]
+            future.set_exception(e)
+            raise
+
+        with self._lock:
+            if len(self.cache) >= self.max_entries:
+                self._evict_expired()
+            self.cache[key] = (time.monotonic(), result)
+            del self.in_flight[key]
+        future.set_result(result)
+        return result
+
+    def subscribe(self, url, parse):
+        """Note a monitor watching url; its cache is kept until every one has unsubscribed"""
+        key = (normalize_url(url), parse)
+        with self._lock:
+            self.subscribers[key] = self.subscribers.get(key, 0) + 1
+
+    def unsubscribe(self, url, parse):
+        """Undo subscribe; the last monitor to leave a URL drops its cache"""
+        key = (normalize_url(url), parse)
+        with self._lock:
+            remaining = self.subscribers.get(key, 0) - 1
+            if remaining > 0:
+                self.subscribers[key] = remaining
+                return
+            self.subscribers.pop(key, None)
+        self.forget(url, parse)
+
+    def forget(self, url, parse):
+        """Drop cached results and validators for url"""
+        key = (normalize_url(url), parse)
+        with self._lock:
+            self.cache.pop(key, None)
+        self.fetcher.forget(key[0], parse)
+
+    def get_stats(self):
+        """Cache effectiveness counters"""
+        lookups = self.hits + self.misses + self.coalesced
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'coalesced': self.coalesced,
+            'hit_rate': (self.hits + self.coalesced) / lookups if lookups else 0.0,
+            'entries': len(self.cache)
+        }
+
+    def _evict_expired(self):
+        cutoff = time.monotonic() - self.ttl
+        for key in [key for key, (fetched_at, _) in self.cache.items() if fetched_at <= cutoff]:
+            del self.cache[key]
+
+
+_session = None
+_fetcher = None
+_resolver = None
+_tls_sessions = None
+_lock = threading.Lock()
+
+
+def get_resolver():
+    """Get the process-wide DNS cache"""
+    global _resolver
+    with _lock:
+        if _resolver is None:
+            _resolver = ResolverCache(ttl=float(os.environ.get('MONITOR_DNS_TTL', 60)),
+                                      max_stale=float(os.environ.get('MONITOR_DNS_MAX_STALE', 600)))
+            REGISTRY.register_stats('dns_cache', _resolver.get_stats, counters=('hits', 'misses', 'stale'))
+        return _resolver
+
+
+def get_session():
+    """Get the process-wide pooled HTTP session, resuming TLS sessions unless MONITOR_TLS_RESUME=0"""
+    global _session, _tls_sessions
+    with _lock:
+        if _session is None:
+            ssl_context = None
+            if os.environ.get('MONITOR_TLS_RESUME', '1') != '0':
+                _tls_sessions = TLSSessionCache()
+                ssl_context = create_ssl_context(_tls_sessions)
+                REGISTRY.register_stats('tls_sessions', _tls_sessions.get_stats, counters=('resumed', 'full'))
+            _session = create_session(int(os.environ.get('MONITOR_MAX_CONCURRENCY', 20)), ssl_context)
+        return _session
+
+
+def get_fetcher():
+    """Get the process-wide shared, conditional fetcher"""
+    global _fetcher
+    session = get_session()
+    with _lock:
+        if _fetcher is None:
+            ttl = float(os.environ.get('MONITOR_FETCH_TTL', 5))
+            max_bytes = int(os.environ.get('MONITOR_FETCH_MAX_BYTES', 1048576))
+            _fetcher = SharedFetcher(ConditionalFetcher(session, max_bytes=max_bytes), ttl=ttl)
+            REGISTRY.register_stats('fetch_cache', _fetcher.get_stats, counters=('hits', 'misses', 'coalesced'))
+            REGISTRY.register_stats('fetch_connections', _fetcher.fetcher.get_stats,
+                                    counters=('unchanged', 'reused', 'closed', 'bytes_read'))
+        return _fetcher
+
+
+def get_connection_stats():
+    """Hit rates of the DNS, TLS session and page caches, for monitor status"""
+    with _lock:
+        caches = {'dns': _resolver, 'tls': _tls_sessions, 'fetch': _fetcher}
+    return {f"{name}_hit_rate": round(cache.get_stats()['hit_rate'], 3)
+            for name, cache in caches.items() if cache is not None}
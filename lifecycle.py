@@ -0,0 +1,94 @@
+import logging
+import os
+import signal
+import sys
+import threading
+import time
+
+# Shutdown stages, run in this order: stop polling and let in-flight checks
+# finish, deliver the alerts they queued, then flush what's left to storage
+POLLING = 0
+ALERTS = 1
+STORAGE = 2
+
+# Set as soon as shutdown begins; long waits (SSE streams, long-polls) watch it
+stopping = threading.Event()
+
+# Set by gunicorn.conf.py when the app is imported once in the master and
+# workers are forked from it; startup callbacks then wait for startup()
+preforking = False
+
+_callbacks = []  # (stage, order registered, name, callback)
+_startup = []  # (name, callback) waiting for startup()
+_lock = threading.Lock()
+_done = False
+
+
+def on_startup(name, callback):
+    """Run callback() to start a component's threads and connections
+
+    Runs right away, unless preforking: threads don't survive fork, so
+    then it runs when each forked worker calls startup().
+    """
+    with _lock:
+        if preforking:
+            _startup.append((name, callback))
+            return
+    callback()
+
+
+def startup():
+    """Run the startup callbacks deferred for preforking; call once in each forked worker"""
+    global preforking
+    with _lock:
+        preforking = False
+        callbacks = list(_startup)
+        _startup.clear()
+    started = time.monotonic()
+    for name, callback in callbacks:
+        callback()
+    if callbacks:
+        logging.info("Started %s in %.2fs", ', '.join(name for name, _ in callbacks), time.monotonic() - started)
+
+
+def on_shutdown(stage, name, callback):
+    """Run callback(timeout) during shutdown, in stage order"""
+    with _lock:
+        _callbacks.append((stage, len(_callbacks), name, callback))
+
+
+def shutdown(timeout=None):
+    """Drain and stop every registered component within timeout seconds overall
+
+    timeout defaults to SHUTDOWN_TIMEOUT (20). Only the first call does
+    anything; returns whether this call performed the shutdown.
+    """
+    global _done
+    stopping.set()
+    with _lock:
+        if _done:
+            return False
+        _done = True
+        callbacks = sorted(_callbacks)
+
+    timeout = float(os.environ.get('SHUTDOWN_TIMEOUT', 20)) if timeout is None else timeout
+    started = time.monotonic()
+    deadline = started + timeout
+    for _, _, name, callback in callbacks:
+        try:
+            callback(max(0.0, deadline - time.monotonic()))
+        except Exception:
+            logging.exception("Shutting down %s failed", name)
+    logging.info("Shutdown finished in %.1fs", time.monotonic() - started)
+    return True
+
+
+def install_signal_handlers():
+    """Drain and exit on SIGTERM or SIGINT; for processes gunicorn doesn't manage"""
+    def handle(signum, frame):
+        logging.info("Received %s, shutting down", signal.Signals(signum).name)
+        shutdown()
+        sys.exit(0)
+
+    signal.signal(signal.SIGTERM, handle)
+    signal.signal(signal.SIGINT, handle)
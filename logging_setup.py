@@ -0,0 +1,198 @@
+import atexit
+import contextvars
+import json
+import logging
+import os
+import queue
+import sys
+import threading
+import time
+from contextlib import contextmanager
+from datetime import datetime, timezone
+from logging.handlers import QueueHandler, QueueListener
+
+from metrics import REGISTRY
+
+# Fields merged into every record logged in the current context, e.g. the
+# monitor a check belongs to
+_context = contextvars.ContextVar('log_context', default={})
+
+# Attributes every LogRecord has; anything else came from extra= or the context
+_STANDARD_ATTRS = set(vars(logging.LogRecord('', 0, '', 0, '', (), None))) | {'message', 'asctime'}
+
+
+@contextmanager
+def log_context(**fields):
+    """Add fields to every record logged inside the block on this thread"""
+    token = _context.set({**_context.get(), **fields})
+    try:
+        yield
+    finally:
+        _context.reset(token)
+
+
+class JsonFormatter(logging.Formatter):
+    """One JSON object per line: ts, level, logger, msg plus any context fields"""
+
+    def format(self, record):
+        entry = {
+            'ts': datetime.fromtimestamp(record.created, timezone.utc).isoformat(timespec='milliseconds'),
+            'level': record.levelname.lower(),
+            'logger': record.name,
+            'msg': record.getMessage()
+        }
+        for key, value in vars(record).items():
+            if key not in _STANDARD_ATTRS and not key.startswith('_'):
+                entry[key] = value
+        if record.exc_info and not record.exc_text:
+            record.exc_text = self.formatException(record.exc_info)
+        if record.exc_text:
+            entry['exc'] = record.exc_text
+        return json.dumps(entry, default=str, ensure_ascii=False)
+
+
+class RateLimitFilter(logging.Filter):
+    """Lets through at most burst records per message template every interval seconds
+
+    Records are keyed by logger, level and the unformatted message, so the
+    same line logged by a thousand monitors counts as one message. The
+    first record let through after a suppression carries a suppressed
+    count.
+    """
+
+    def __init__(self, burst=20, interval=10.0, max_keys=10000):
+        super().__init__()
+        self.burst = burst
+        self.interval = interval
+        self.max_keys = max_keys
+        self.windows = {}  # key -> [window start, records let through, records suppressed]
+        self._lock = threading.Lock()
+
+    def filter(self, record):
+        key = (record.name, record.levelno, record.msg if isinstance(record.msg, str) else type(record.msg))
+        now = time.monotonic()
+        with self._lock:
+            window = self.windows.get(key)
+            if window is None or now - window[0] >= self.interval:
+                suppressed = window[2] if window else 0
+                if window is None and len(self.windows) >= self.max_keys:
+                    self.windows.clear()
+                window = self.windows[key] = [now, 0, 0]
+                if suppressed:
+                    record.suppressed = suppressed
+            if window[1] >= self.burst:
+                window[2] += 1
+                return False
+            window[1] += 1
+        return True
+
+
+class NonBlockingQueueHandler(QueueHandler):
+    """Hands records to the background writer without ever blocking the caller
+
+    The record is reduced to its final message and context fields here;
+    JSON formatting and the write happen on the listener thread. When the
+    queue is full the record is dropped and counted.
+    """
+
+    def __init__(self, log_queue):
+        super().__init__(log_queue)
+        self.dropped = 0
+
+    def prepare(self, record):
+        record = logging.makeLogRecord(vars(record))
+        record.msg = record.getMessage()
+        record.args = None
+        if record.exc_info:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        for key, value in _context.get().items():
+            if not hasattr(record, key):
+                setattr(record, key, value)
+        return record
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+    def get_stats(self):
+        return {'queued': self.queue.qsize(), 'dropped': self.dropped}
+
+
+_listener = None
+_handler = None
+_lock = threading.Lock()
+
+
+def _install(stream, max_queue):
+    """Put a new queue handler on the root logger and start a writer thread for it"""
+    global _listener, _handler
+    handler = NonBlockingQueueHandler(queue.Queue(max_queue))
+    handler.addFilter(RateLimitFilter())
+    root = logging.getLogger()
+    for existing in list(root.handlers):
+        root.removeHandler(existing)
+    root.addHandler(handler)
+    _handler = handler
+    _listener = QueueListener(handler.queue, stream, respect_handler_level=True)
+    _listener.start()
+    return _listener
+
+
+def _queue_stats():
+    return _handler.get_stats() if _handler else {'queued': 0, 'dropped': 0}
+
+
+def setup_logging(level=None, fmt=None, max_queue=10000):
+    """Route the root logger through a queue to a background stderr writer
+
+    level defaults to LOG_LEVEL (INFO) and fmt to LOG_FORMAT: json, or
+    text for a human-readable line. Safe to call more than once.
+    """
+    global _listener
+    level = (level or os.environ.get('LOG_LEVEL', 'INFO')).upper()
+    fmt = fmt or os.environ.get('LOG_FORMAT', 'json')
+
+    with _lock:
+        if _listener is not None:
+            _listener.stop()
+            _listener = None
+
+        stream = logging.StreamHandler(sys.stderr)
+        if fmt == 'text':
+            stream.setFormatter(logging.Formatter('%(asctime)s %(levelname)s %(name)s: %(message)s'))
+        else:
+            stream.setFormatter(JsonFormatter())
+
+        logging.getLogger().setLevel(level)
+        REGISTRY.register_stats('log_queue', _queue_stats, counters=('dropped',))
+        return _install(stream, max_queue)
+
+
+def _restart_listener():
+    """Give the child its own queue, handler and writer thread
+
+    The writer thread doesn't survive fork, and the inherited queue's and
+    filter's locks may have been held by a parent thread at that moment,
+    so none of them are reused; only the stream handler, whose lock
+    logging resets at fork, carries over.
+    """
+    global _lock
+    _lock = threading.Lock()
+    if _listener is not None:
+        _install(_listener.handlers[0], _handler.queue.maxsize)
+
+
+os.register_at_fork(after_in_child=_restart_listener)
+
+
+@atexit.register
+def _flush_logs():
+    """Write out whatever is still queued when the process exits"""
+    global _listener
+    with _lock:
+        if _listener is not None:
+            _listener.stop()
+            _listener = None
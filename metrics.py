@@ -0,0 +1,282 @@
+import bisect
+import math
+import threading
+import time
+
+# Upper bounds in seconds; the last bucket is +Inf
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+
+def _format_value(value):
+    if value == math.inf:
+        return '+Inf'
+    if isinstance(value, float) and value.is_integer():
+        return str(int(value))
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+def _format_labels(labels):
+    if not labels:
+        return ''
+    pairs = ','.join('{}="{}"'.format(name, str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n'))
+                     for name, value in labels.items())
+    return '{' + pairs + '}'
+
+
+class Metric:
+    """A named family of samples, one per combination of label values
+
+    Updates take a short per-metric lock, which keeps them exact when
+    called from the engine's worker threads at a cost of about a
+    microsecond.
+    """
+
+    type = 'untyped'
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._lock = threading.Lock()
+
+    def _labels(self, values):
+        return dict(zip(self.labelnames, values))
+
+    def samples(self):
+        """[(sample name, labels dict, value)]"""
+        raise NotImplementedError
+
+    def collect(self):
+        """JSON-safe family: {name, type, help, samples}"""
+        return {'name': self.name, 'type': self.type, 'help': self.documentation,
+                'samples': [[name, labels, value] for name, labels, value in self.samples()]}
+
+
+class Counter(Metric):
+    """Monotonic total, e.g. checks by result"""
+
+    type = 'counter'
+
+    def __init__(self, name, documentation, labelnames=()):
+        super().__init__(name, documentation, labelnames)
+        self.values = {}
+
+    def inc(self, *labels, amount=1):
+        with self._lock:
+            self.values[labels] = self.values.get(labels, 0) + amount
+
+    def get(self, *labels):
+        return self.values.get(labels, 0)
+
+    def samples(self):
+        with self._lock:
+            items = list(self.values.items())
+        return [(f'{self.name}_total', self._labels(labels), value) for labels, value in items]
+
+
+class Gauge(Metric):
+    """Value that goes up and down
+
+    Pass function to read the value at scrape time instead of setting it;
+    it returns a number, or {label values tuple: number}.
+    """
+
+    type = 'gauge'
+
+    def __init__(self, name, documentation, labelnames=(), function=None):
+        super().__init__(name, documentation, labelnames)
+        self.function = function
+        self.values = {}
+
+    def set(self, value, *labels):
+        with self._lock:
+            self.values[labels] = value
+
+    def samples(self):
+        if self.function is not None:
+            value = self.function()
+            items = value.items() if isinstance(value, dict) else [((), value)]
+        else:
+            with self._lock:
+                items = list(self.values.items())
+        return [(self.name, self._labels(labels), value) for labels, value in items if value is not None]
+
+
+class Histogram(Metric):
+    """Distribution of observed values, e.g. seconds per check phase"""
+
+    type = 'histogram'
+
+    def __init__(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(sorted(buckets))
+        self.series = {}  # label values -> [bucket counts..., +Inf count, sum]
+
+    def observe(self, value, *labels):
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            series = self.series.get(labels)
+            if series is None:
+                series = self.series[labels] = [0] * (len(self.buckets) + 2)
+            series[index] += 1
+            series[-1] += value
+
+    def time(self, *labels):
+        """Context manager observing the duration of its block"""
+        return _Timer(self, labels)
+
+    def samples(self):
+        with self._lock:
+            items = [(labels, list(series)) for labels, series in self.series.items()]
+        samples = []
+        for labels, series in items:
+            base = self._labels(labels)
+            cumulative = 0
+            for bound, count in zip(self.buckets + (math.inf,), series):
+                cumulative += count
+                samples.append((f'{self.name}_bucket', {**base, 'le': _format_value(bound)}, cumulative))
+            samples.append((f'{self.name}_sum', base, series[-1]))
+            samples.append((f'{self.name}_count', base, cumulative))
+        return samples
+
+
+class _Timer:
+    def __init__(self, histogram, labels):
+        self.histogram = histogram
+        self.labels = labels
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.histogram.observe(time.perf_counter() - self.start, *self.labels)
+
+
+class RateMeter:
+    """Events per second over a sliding window of one-second buckets"""
+
+    def __init__(self, window=60):
+        self.window = window
+        self.counts = [0] * window
+        self.seconds = [0] * window
+        self._lock = threading.Lock()
+
+    def mark(self, count=1):
+        second = int(time.time())
+        slot = second % self.window
+        with self._lock:
+            if self.seconds[slot] != second:
+                self.seconds[slot] = second
+                self.counts[slot] = 0
+            self.counts[slot] += count
+
+    def rate(self):
+        """Average per second over the completed seconds of the window"""
+        now = int(time.time())
+        with self._lock:
+            total = sum(count for second, count in zip(self.seconds, self.counts) if now - self.window < second < now)
+        return total / (self.window - 1)
+
+
+class MetricsRegistry:
+    """Every metric in the process, rendered in the Prometheus text format"""
+
+    def __init__(self):
+        self.metrics = {}
+        self._lock = threading.Lock()
+
+    def register(self, metric):
+        """Add metric, replacing any earlier one with the same name"""
+        with self._lock:
+            self.metrics[metric.name] = metric
+        return metric
+
+    def counter(self, name, documentation, labelnames=()):
+        return self.register(Counter(name, documentation, labelnames))
+
+    def gauge(self, name, documentation, labelnames=(), function=None):
+        return self.register(Gauge(name, documentation, labelnames, function))
+
+    def histogram(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        return self.register(Histogram(name, documentation, labelnames, buckets))
+
+    def register_stats(self, prefix, get_stats, counters=()):
+        """Export each numeric key of a component's get_stats() dict
+
+        Keys listed in counters become <prefix>_<key>_total counters, the
+        rest <prefix>_<key> gauges. Values are read at scrape time, so the
+        component keeps its own plain attributes on the hot path.
+        """
+        for key, value in get_stats().items():
+            if not isinstance(value, (int, float)):
+                continue
+            read = (lambda key: lambda: get_stats().get(key))(key)
+            if key in counters:
+                self.register(_StatsCounter(f'{prefix}_{key}', f'{prefix} {key}', read))
+            else:
+                self.gauge(f'{prefix}_{key}', f'{prefix} {key}', function=read)
+
+    def collect(self, extra_labels=None):
+        """JSON-safe families, optionally with extra labels on every sample"""
+        with self._lock:
+            metrics = list(self.metrics.values())
+        families = []
+        for metric in metrics:
+            family = metric.collect()
+            if extra_labels:
+                for sample in family['samples']:
+                    sample[1] = {**extra_labels, **sample[1]}
+            families.append(family)
+        return families
+
+    def render(self, extra_families=()):
+        """Text exposition of this process's metrics plus extra_families
+
+        Families with the same name (e.g. one per shard process) are merged.
+        """
+        merged = {}
+        for family in list(self.collect()) + list(extra_families):
+            existing = merged.get(family['name'])
+            if existing is None:
+                merged[family['name']] = {**family, 'samples': list(family['samples'])}
+            else:
+                existing['samples'].extend(family['samples'])
+
+        lines = []
+        for family in merged.values():
+            lines.append(f"# HELP {family['name']} {family['help']}")
+            lines.append(f"# TYPE {family['name']} {family['type']}")
+            for name, labels, value in family['samples']:
+                lines.append(f"{name}{_format_labels(labels)} {_format_value(value)}")
+        return '\n'.join(lines) + '\n'
+
+
+class _StatsCounter(Counter):
+    def __init__(self, name, documentation, read):
+        super().__init__(name, documentation)
+        self.read = read
+
+    def samples(self):
+        value = self.read()
+        return [] if value is None else [(f'{self.name}_total', {}, value)]
+
+
+REGISTRY = MetricsRegistry()
+
+CHECK_SECONDS = REGISTRY.histogram(
+    'testflight_check_seconds', 'Wall time of one slot check')
+CHECK_PHASE_SECONDS = REGISTRY.histogram(
+    'testflight_check_phase_seconds',
+    'Time per fetch phase; dns, connect and tls only occur on new connections', ('phase',))
+CHECKS = REGISTRY.counter(
+    'testflight_checks', 'Slot checks by result (open, full, error)', ('result',))
+FETCHES = REGISTRY.counter(
+    'testflight_fetches', 'Outbound page fetches by HTTP status', ('status',))
+TELEGRAM_SEND_SECONDS = REGISTRY.histogram(
+    'telegram_send_seconds', 'Latency of one Telegram sendMessage request')
+TELEGRAM_SENDS = REGISTRY.counter(
+    'telegram_sends', 'Telegram sendMessage requests by outcome (ok, rate_limited, error)', ('outcome',))
+
+POLL_RATE = RateMeter()
+REGISTRY.gauge('testflight_polls_per_second', 'Checks per second over the last minute', function=POLL_RATE.rate)
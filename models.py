@@ -1,8 +1,49 @@
 from datetime import datetime
-from app import db
+from sqlalchemy import insert, or_, tuple_
+from sqlalchemy.exc import IntegrityError
+from database import db
+
+def encode_cursor(row):
+    """Opaque keyset cursor pointing just past row"""
+    return f"{row.timestamp.isoformat()}_{row.id}"
+
+def decode_cursor(cursor):
+    """Split a cursor back into (timestamp, id); raises ValueError if malformed"""
+    timestamp, _, row_id = cursor.rpartition('_')
+    return datetime.fromisoformat(timestamp), int(row_id)
+
+class KeysetPageMixin:
+    """Newest-first keyset pagination over (timestamp, id)
+    
+    Each page seeks straight to the cursor through the (..., timestamp)
+    indexes, so cost is proportional to the rows returned rather than to
+    how deep the page is, unlike OFFSET.
+    """
+    
+    @classmethod
+    def page(cls, testflight_url=None, since=None, until=None, cursor=None, limit=50, **filters):
+        """Get one page of rows, newest first; returns (rows, next_cursor)"""
+        query = cls.query.filter_by(**filters)
+        if testflight_url:
+            query = query.filter(cls.testflight_url == testflight_url)
+        if since:
+            query = query.filter(cls.timestamp >= since)
+        if until:
+            query = query.filter(cls.timestamp < until)
+        if cursor:
+            query = query.filter(tuple_(cls.timestamp, cls.id) < decode_cursor(cursor))
+        
+        rows = query.order_by(cls.timestamp.desc(), cls.id.desc()).limit(limit + 1).all()
+        if len(rows) > limit:
+            return rows[:limit], encode_cursor(rows[limit - 1])
+        return rows, None
 
 class MonitorConfig(db.Model):
-    """Configuration settings for the TestFlight monitor"""
+    """Configuration settings for one TestFlight monitor"""
+    __table_args__ = (
+        db.Index('ix_monitor_config_url', 'testflight_url'),
+    )
+    
     id = db.Column(db.Integer, primary_key=True)
     bot_token = db.Column(db.String(200), nullable=False)
     chat_id = db.Column(db.String(50), nullable=False)
@@ -10,18 +51,37 @@ class MonitorConfig(db.Model):
     check_interval = db.Column(db.Integer, default=60)  # seconds
     created_at = db.Column(db.DateTime, default=datetime.utcnow)
     updated_at = db.Column(db.DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
+    running = db.Column(db.Boolean, default=False)  # restarted on boot when set
+    already_alerted = db.Column(db.Boolean, default=False)  # so a restart doesn't re-alert an open slot
+    
+    def to_config(self):
+        """Config dict in the form TestFlightMonitor.update_config takes"""
+        return {
+            'bot_token': self.bot_token,
+            'chat_id': self.chat_id,
+            'testflight_url': self.testflight_url,
+            'check_interval': self.check_interval
+        }
     
     @classmethod
     def get_current(cls):
         """Get the current configuration (latest one)"""
         return cls.query.order_by(cls.updated_at.desc()).first()
 
-class MonitorLog(db.Model):
+class MonitorLog(KeysetPageMixin, db.Model):
     """Log entries for monitoring activity"""
+    __table_args__ = (
+        db.Index('ix_monitor_log_timestamp', 'timestamp'),
+        db.Index('ix_monitor_log_url_timestamp', 'testflight_url', 'timestamp'),
+        db.Index('ix_monitor_log_url_level_timestamp', 'testflight_url', 'level', 'timestamp'),
+        db.Index('ix_monitor_log_level_timestamp', 'level', 'timestamp'),
+    )
+    
     id = db.Column(db.Integer, primary_key=True)
     timestamp = db.Column(db.DateTime, default=datetime.utcnow)
     level = db.Column(db.String(20), nullable=False)  # info, success, warning, error
     message = db.Column(db.Text, nullable=False)
+    testflight_url = db.Column(db.String(500))  # monitor the entry belongs to
     
     @classmethod
     def add_log(cls, level, message):
@@ -32,9 +92,15 @@ class MonitorLog(db.Model):
         return log
     
     @classmethod
-    def get_recent(cls, limit=50):
+    def bulk_insert(cls, rows):
+        """Insert many entries without committing; used by the history writer"""
+        if rows:
+            db.session.execute(insert(cls), rows)
+    
+    @classmethod
+    def get_recent(cls, limit=50, testflight_url=None):
         """Get recent log entries"""
-        return cls.query.order_by(cls.timestamp.desc()).limit(limit).all()
+        return cls.page(testflight_url=testflight_url, limit=limit)[0]
     
     @classmethod
     def clear_all(cls):
@@ -61,3 +127,96 @@ class MonitorLog(db.Model):
             'error': '❌'
         }
         return icon_map.get(self.level, 'ℹ️')
+
+class CheckResult(KeysetPageMixin, db.Model):
+    """Outcome of a single slot check"""
+    __table_args__ = (
+        db.Index('ix_check_result_url_timestamp', 'testflight_url', 'timestamp'),
+    )
+    
+    id = db.Column(db.Integer, primary_key=True)
+    testflight_url = db.Column(db.String(500), nullable=False)
+    timestamp = db.Column(db.DateTime, default=datetime.utcnow)
+    available = db.Column(db.Boolean)  # None when the check failed
+    error = db.Column(db.Text)
+    
+    @classmethod
+    def bulk_insert(cls, rows):
+        """Insert many results without committing; used by the history writer"""
+        if rows:
+            db.session.execute(insert(cls), rows)
+
+class StateTransition(db.Model):
+    """A run of consecutive checks with the same outcome, produced by compaction"""
+    __table_args__ = (
+        db.Index('ix_state_transition_url_started', 'testflight_url', 'started_at'),
+    )
+    
+    id = db.Column(db.Integer, primary_key=True)
+    testflight_url = db.Column(db.String(500), nullable=False)
+    state = db.Column(db.String(10), nullable=False)  # open, full, error
+    started_at = db.Column(db.DateTime, nullable=False)
+    ended_at = db.Column(db.DateTime, nullable=False)
+    count = db.Column(db.Integer, nullable=False, default=1)
+    
+    @classmethod
+    def latest(cls, testflight_url):
+        """Get the most recent run for a URL"""
+        return cls.query.filter_by(testflight_url=testflight_url).order_by(cls.started_at.desc()).first()
+
+class CheckAggregate(db.Model):
+    """Check counts for one URL over an hour or a day, produced by compaction"""
+    __table_args__ = (
+        db.UniqueConstraint('testflight_url', 'period', 'bucket_start', name='uq_check_aggregate_bucket'),
+        db.Index('ix_check_aggregate_period_bucket', 'period', 'bucket_start'),
+    )
+    
+    id = db.Column(db.Integer, primary_key=True)
+    testflight_url = db.Column(db.String(500), nullable=False)
+    period = db.Column(db.String(10), nullable=False)  # hour, day
+    bucket_start = db.Column(db.DateTime, nullable=False)
+    checks = db.Column(db.Integer, nullable=False, default=0)
+    open_count = db.Column(db.Integer, nullable=False, default=0)
+    full_count = db.Column(db.Integer, nullable=False, default=0)
+    error_count = db.Column(db.Integer, nullable=False, default=0)
+    
+    def merge(self, checks, open_count, full_count, error_count):
+        """Add counts from finer-grained data into this bucket"""
+        self.checks = (self.checks or 0) + checks
+        self.open_count = (self.open_count or 0) + open_count
+        self.full_count = (self.full_count or 0) + full_count
+        self.error_count = (self.error_count or 0) + error_count
+
+class JobLease(db.Model):
+    """Which process may run a periodic job until expires_at
+
+    Lets one of several web workers or shards run a job like compaction
+    while the others skip it. A lease is claimed with a conditional
+    update, so two processes can't both win it.
+    """
+    name = db.Column(db.String(50), primary_key=True)
+    owner = db.Column(db.String(100), nullable=False)
+    expires_at = db.Column(db.DateTime, nullable=False)
+    
+    @classmethod
+    def acquire(cls, name, owner, duration):
+        """Claim or renew the lease for duration; False while someone else holds it"""
+        now = datetime.utcnow()
+        claimed = cls.query.filter(cls.name == name, or_(cls.expires_at <= now, cls.owner == owner)) \
+            .update({'owner': owner, 'expires_at': now + duration}, synchronize_session=False)
+        if claimed:
+            db.session.commit()
+            return True
+        try:
+            db.session.add(cls(name=name, owner=owner, expires_at=now + duration))
+            db.session.commit()
+            return True
+        except IntegrityError:  # the row exists and someone else holds it
+            db.session.rollback()
+            return False
+    
+    @classmethod
+    def release(cls, name, owner):
+        """Give up the lease early, e.g. on shutdown"""
+        cls.query.filter_by(name=name, owner=owner).update({'expires_at': datetime.utcnow()})
+        db.session.commit()
@@ -1,127 +1,300 @@
-import threading
-import time
 import requests
-from bs4 import BeautifulSoup
 import logging
-from datetime import datetime
+import threading
+import time
+import weakref
+import lifecycle
+from engine import AdaptiveSchedule, PollTarget, get_engine
+from http_pool import get_connection_stats, get_fetcher, parse_retry_after
+from detector import get_detector
+from alerts import TelegramAlerter
+from ringbuffer import RingBuffer
+from metrics import CHECK_SECONDS, CHECKS
+from logging_setup import log_context
+from records import CounterTable, LogEntry, from_ms, now_ms
+
+# Logged on every uneventful poll; compaction prunes these first
+STILL_FULL_MESSAGE = '❌ TestFlight beta is still full'
+STILL_OPEN_MESSAGE = '✅ Slot still available (alert already sent)'
+ROUTINE_MESSAGES = (STILL_FULL_MESSAGE, STILL_OPEN_MESSAGE)
+
+# Per-monitor numbers, one row per monitor; timestamps are epoch ms, 0 for never
+_STATE = CounterTable(('last_check', 'last_changed', 'error_count', 'checks', 'alerts'))
+
+
+def _state_field(field, doc):
+    return property(lambda self: _STATE.get(self._row, field),
+                    lambda self, value: _STATE.set(self._row, field, value), doc=doc)
+
+
+class CheckError(Exception):
+    """A failed slot check, carrying the server's Retry-After if it sent one"""
+    
+    def __init__(self, message, retry_after=None):
+        super().__init__(message)
+        self.retry_after = retry_after
 
 class TestFlightMonitor:
-    """Background monitor for TestFlight slot availability"""
+    """Background monitor for TestFlight slot availability
+    
+    Scheduling, detection and alerting are pluggable: pass a PollingEngine,
+    a detector.Detector and an alerts.Alerter to override the defaults.
+    Pass a history.HistoryWriter to persist logs and check results, and
+    on_alert_state to be told when already_alerted changes so it can
+    survive a restart. When it returns False for a change to True another
+    process already claimed the alert, and this one isn't sent.
+    
+    start, stop and restart are safe to call from any thread. Checks of one
+    monitor never overlap, and stop waits for a check already running, so
+    a quick stop/start can't leave two checks racing to send the same alert.
+    
+    Monitors are kept compact so a process can hold tens of thousands:
+    attributes are slotted, numeric state lives in a shared CounterTable
+    row and log entries are slotted records. get_status() and the
+    entries' level/created properties give the display form.
+    """
+    
+    __slots__ = ('engine', 'detector', 'alerter', 'history', 'key', 'running', 'config', 'already_alerted',
+                 'last_result', 'schedule', 'logs', 'version', 'on_alert_state', '_changed', '_lifecycle',
+                 '_check_lock', '_row', '__weakref__')
+    
+    last_check = _state_field('last_check', "Epoch ms of the last check")
+    last_changed = _state_field('last_changed', "Epoch ms when the page content last changed")
+    error_count = _state_field('error_count', "Consecutive failed checks")
+    checks = _state_field('checks', "Checks run")
+    alerts = _state_field('alerts', "Alerts sent")
     
-    def __init__(self):
-        self.thread = None
+    def __init__(self, engine=None, detector=None, alerter=None, log_capacity=50, history=None, key=None,
+                 on_alert_state=None):
+        self.engine = engine or get_engine()
+        self.detector = detector
+        self.alerter = alerter or TelegramAlerter()
+        self.history = history
+        self.key = key or f"monitor-{id(self)}"
+        self._row = _STATE.allocate()
+        weakref.finalize(self, _STATE.release, self._row)
         self.running = False
         self.config = None
         self.already_alerted = False
-        self.last_check = None
         self.last_result = None
-        self.error_count = 0
-        self.logs = []  # Store logs in memory
+        self.schedule = None
+        self.logs = RingBuffer(log_capacity)  # Store recent logs in memory
+        self.version = 0  # bumped on every log entry or status change
+        self.on_alert_state = on_alert_state
+        self._changed = threading.Condition()
+        self._lifecycle = threading.RLock()  # serializes start/stop/restart
+        self._check_lock = threading.Lock()  # held for the duration of a check
         
     def update_config(self, config):
-        """Update monitor configuration"""
-        self.config = config
+        """Update monitor configuration; takes effect from the next check"""
+        with self._lifecycle:
+            if self.running and self._page(self.config) != self._page(config):
+                # The shared page cache is kept per URL and parser: follow the change
+                get_fetcher().unsubscribe(*self._page(self.config))
+                get_fetcher().subscribe(*self._page(config))
+            if self.config and self.config['testflight_url'] != config['testflight_url']:
+                # A different beta: reset alert state
+                self._set_alerted(False)
+                self.last_result = None
+                self.last_changed = 0
+            self.config = config
+            if self.schedule:
+                self.schedule.interval = config['check_interval']
         
     def is_running(self):
         """Check if monitor is currently running"""
-        return self.running and self.thread and self.thread.is_alive()
+        return self.running and self.engine.has_target(self.key)
     
-    def start(self):
-        """Start monitoring in background thread"""
-        if self.is_running():
-            return False
-        
-        if not self.config:
-            raise Exception("No configuration available")
+    def start(self, stagger=False):
+        """Start monitoring on the shared polling engine
         
-        self.running = True
-        self.thread = threading.Thread(target=self._monitor_loop, daemon=True)
-        self.thread.start()
-        return True
+        Pass stagger when starting many monitors at once to spread their
+        first checks over one interval. Returns False if already running or
+        the process is shutting down.
+        """
+        with self._lifecycle:
+            if self.is_running():
+                return False
+            
+            if not self.config:
+                raise Exception("No configuration available")
+            
+            schedule = AdaptiveSchedule(self.config['check_interval'])
+            if not self.engine.add_target(PollTarget(self.key, self._check_once, schedule), stagger=stagger):
+                return False
+            self.schedule = schedule
+            self.running = True
+            get_fetcher().subscribe(*self._page(self.config))
+            self._notify()
+            logging.info("TestFlight monitoring started", extra={'monitor': self.key})
+            self.add_log('info', 'Monitoring started')
+            return True
     
-    def stop(self):
-        """Stop monitoring"""
-        if not self.is_running():
-            return False
-        
-        self.running = False
-        if self.thread:
-            self.thread.join(timeout=5)
-        return True
+    def stop(self, timeout=10):
+        """Stop monitoring, waiting up to timeout seconds for a check already running"""
+        with self._lifecycle:
+            if not self.running:
+                return False
+            
+            self.running = False
+            self.engine.remove_target(self.key)
+            if self._check_lock.acquire(timeout=timeout):
+                self._check_lock.release()
+            else:
+                logging.warning("Stopped while a check was still running", extra={'monitor': self.key})
+            self._notify()
+            # Other monitors of the same page keep its cache
+            get_fetcher().unsubscribe(*self._page(self.config))
+            logging.info("TestFlight monitoring stopped", extra={'monitor': self.key})
+            self.add_log('info', 'Monitoring stopped')
+            return True
+    
+    def restart(self):
+        """Stop if running, then start again with a fresh schedule"""
+        with self._lifecycle:
+            self.stop()
+            return self.start()
     
     def get_status(self):
         """Get current monitoring status"""
         return {
             'running': self.is_running(),
-            'last_check': self.last_check,
+            'last_check': from_ms(self.last_check),
             'last_result': self.last_result,
+            'last_changed': from_ms(self.last_changed),
             'already_alerted': self.already_alerted,
-            'error_count': self.error_count
+            'error_count': self.error_count,
+            'checks': self.checks,
+            'alerts': self.alerts,
+            'connections': get_connection_stats()  # shared by every monitor in this process
         }
     
     def add_log(self, level, message):
         """Add a log entry"""
-        log_entry = {
-            'timestamp': datetime.utcnow(),
-            'level': level,
-            'message': message
-        }
-        self.logs.append(log_entry)
-        # Keep only last 50 logs
-        if len(self.logs) > 50:
-            self.logs = self.logs[-50:]
+        entry = LogEntry.create(level, message)
+        if self.history:
+            self.history.add_log(level, message, self.config and self.config['testflight_url'], entry.created)
+        seq = self.logs.append(entry)
+        self._notify()
+        return seq
+    
+    @property
+    def last_log_seq(self):
+        """Sequence number of the newest log entry"""
+        return self.logs.last_seq
     
-    def get_logs(self):
-        """Get recent log entries"""
-        return list(reversed(self.logs))  # Most recent first
+    def get_logs(self, since=0):
+        """Get log entries newer than sequence number since, most recent first"""
+        return self.logs.since(since)
+    
+    def get_log_items(self, since=0, limit=None):
+        """(seq, entry) pairs newer than since, most recent first"""
+        return self.logs.items_since(since, limit)
     
     def clear_logs(self):
         """Clear all log entries"""
-        self.logs = []
+        self.logs.clear()
+        self._notify()
     
-    def _monitor_loop(self):
-        """Main monitoring loop"""
-        logging.info("TestFlight monitoring started")
-        
-        while self.running:
-            try:
-                self.last_check = datetime.utcnow()
-                slot_available = self._check_slot_availability()
-                self.last_result = slot_available
-                
-                if slot_available:
-                    if not self.already_alerted:
+    def wait_for_change(self, version, timeout):
+        """Block until version moves past the given one or timeout; returns the current version
+
+        Waits in slices of at most a second so shutdown isn't held up by an
+        open long-poll or event stream.
+        """
+        deadline = time.monotonic() + (timeout or 0)
+        with self._changed:
+            while self.version == version and not lifecycle.stopping.is_set():
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                self._changed.wait(min(remaining, 1.0))
+            return self.version
+    
+    def _notify(self):
+        with self._changed:
+            self.version += 1
+            self._changed.notify_all()
+    
+    def _check_once(self):
+        """Run a single check; scheduled by the polling engine"""
+        with self._check_lock:
+            # Re-checked under the lock: stop() may have run while this check was queued
+            if not self.running:
+                return
+            with log_context(monitor=self.key, url=self.config['testflight_url']), CHECK_SECONDS.time():
+                self._run_check()
+    
+    def _run_check(self):
+        try:
+            self.last_check = now_ms()
+            self.checks += 1
+            slot_available = self._check_slot_availability()
+            # Same verdict as last time and nothing to recover from: skip the routine log line
+            unchanged = slot_available == self.last_result and not self.error_count
+            if self.last_result is not None and slot_available != self.last_result:
+                logging.info("Slot state changed, checking more often for a while")
+            self.last_result = slot_available
+            self.error_count = 0  # Reset error count on successful check
+            self.schedule.record_result(slot_available)
+            CHECKS.inc('open' if slot_available else 'full')
+            if self.history:
+                self.history.add_check(self.config['testflight_url'], slot_available, timestamp=from_ms(self.last_check))
+            
+            if unchanged and (self.already_alerted or not slot_available):
+                self._notify()  # last_check moved
+            elif slot_available:
+                if not self.already_alerted:
+                    if self._set_alerted(True):
                         logging.info("Slot found! Sending Telegram alert...")
-                        self._send_telegram_alert()
-                        self.already_alerted = True
+                        try:
+                            self._send_alert()
+                        except Exception:
+                            self._set_alerted(False)  # give up the claim so the next check retries
+                            raise
+                        self.alerts += 1
                         self.add_log('success', '🚨 TestFlight slot opened! Alert sent.')
                     else:
-                        logging.info("Slot still open, alert already sent")
-                        self.add_log('info', '✅ Slot still available (alert already sent)')
+                        logging.info("Slot found, alert already sent by another process")
                 else:
-                    logging.info("Still full, checking again...")
-                    self.add_log('info', '❌ TestFlight beta is still full')
-                    self.already_alerted = False  # Reset if it goes back to full
-                
-                self.error_count = 0  # Reset error count on successful check
-                
-            except Exception as e:
-                self.error_count += 1
-                logging.error(f"Monitor error: {e}")
-                self.add_log('error', f'Monitor error: {str(e)}')
-                
-                # Stop monitoring after too many consecutive errors
-                if self.error_count >= 5:
-                    logging.error("Too many consecutive errors, stopping monitor")
-                    self.add_log('error', 'Too many consecutive errors, stopping monitor')
-                    self.running = False
-                    break
+                    logging.debug("Slot still open, alert already sent")
+                    self.add_log('info', STILL_OPEN_MESSAGE)
+            else:
+                logging.debug("Still full, checking again...")
+                self._set_alerted(False)  # Reset if it goes back to full
+                self.add_log('info', STILL_FULL_MESSAGE)
             
-            # Wait for the configured interval
-            if self.running and self.config:
-                time.sleep(self.config['check_interval'])
-        
-        logging.info("TestFlight monitoring stopped")
+        except Exception as e:
+            self.error_count += 1
+            CHECKS.inc('error')
+            self.schedule.record_error(getattr(e, 'retry_after', None))
+            logging.error("Monitor error: %s", e)
+            if self.history:
+                self.history.add_check(self.config['testflight_url'], None, error=str(e),
+                                       timestamp=from_ms(self.last_check))
+            self.add_log('error', f'Monitor error: {str(e)}')
+            
+            # Keep going, but back off; say so once when errors pile up
+            if self.error_count == 5:
+                logging.warning("Too many consecutive errors, backing off")
+                self.add_log('warning', 'Too many consecutive errors, backing off')
+    
+    def _set_alerted(self, alerted):
+        """Record the alert state; returns False if another process already claimed the alert"""
+        if alerted == self.already_alerted:
+            return True
+        self.already_alerted = alerted
+        if self.on_alert_state:
+            return self.on_alert_state(alerted) is not False
+        return True
+    
+    def _get_detector(self, config=None):
+        """Detector for this monitor, chosen by the configured locale unless given"""
+        return self.detector or get_detector((config or self.config).get('locale'))
+    
+    def _page(self, config):
+        """(url, parse) the shared fetcher caches this monitor's page under"""
+        return config['testflight_url'], self._get_detector(config).check_response
     
     def _check_slot_availability(self):
         """Check if TestFlight slots are available"""
@@ -129,66 +302,26 @@ class TestFlightMonitor:
             return False
             
         try:
-            headers = {
-                'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/91.0.4472.124 Safari/537.36'
-            }
-            
-            response = requests.get(
-                self.config['testflight_url'], 
-                timeout=10,
-                headers=headers
-            )
-            response.raise_for_status()
-            
-            # Check if the page indicates the beta is full
-            soup = BeautifulSoup(response.text, 'html.parser')
-            
-            # Look for common indicators that the beta is full
-            full_indicators = [
-                "This beta is full.",
-                "This beta isn't accepting any new testers right now.",
-                "beta is full",
-                "not accepting"
-            ]
-            
-            page_text = response.text.lower()
-            for indicator in full_indicators:
-                if indicator.lower() in page_text:
-                    return False
-            
-            # If none of the "full" indicators are found, assume slots are available
-            return True
+            # A 304 or an unchanged page reuses the previous verdict without re-parsing
+            # Only share a fetch well inside this monitor's own interval, so a check is never its last one replayed
+            max_age = self.schedule.shortest_delay() / 2 if self.schedule else 0
+            result = get_fetcher().fetch(self.config['testflight_url'], self._get_detector().check_response,
+                                         max_age=max_age)
+            self.last_changed = result.changed_at or 0
+            return result.value
             
         except requests.RequestException as e:
-            logging.error(f"Error checking TestFlight: {e}")
-            raise Exception(f"Failed to check TestFlight URL: {str(e)}")
+            logging.error("Error checking TestFlight: %s", e)
+            raise CheckError(f"Failed to check TestFlight URL: {str(e)}",
+                             parse_retry_after(getattr(e, 'response', None)))
         except Exception as e:
-            logging.error(f"Unexpected error checking TestFlight: {e}")
+            logging.error("Unexpected error checking TestFlight: %s", e)
             raise
     
-    def _send_telegram_alert(self):
-        """Send Telegram alert when slot becomes available"""
+    def _send_alert(self):
+        """Send an alert when slot becomes available"""
         if not self.config:
             return False
             
-        try:
-            message = f"🚨 A TestFlight beta slot just opened! Join now:\n{self.config['testflight_url']}"
-            
-            url = f"https://api.telegram.org/bot{self.config['bot_token']}/sendMessage"
-            params = {
-                "chat_id": self.config['chat_id'],
-                "text": message,
-                "parse_mode": "HTML"
-            }
-            
-            response = requests.get(url, params=params, timeout=10)
-            response.raise_for_status()
-            
-            logging.info("Telegram alert sent successfully")
-            
-        except requests.RequestException as e:
-            logging.error(f"Failed to send Telegram alert: {e}")
-            raise Exception(f"Failed to send Telegram alert: {str(e)}")
-        except Exception as e:
-            logging.error(f"Unexpected error sending Telegram alert: {e}")
-            raise
+        message = f"🚨 A TestFlight beta slot just opened! Join now:\n{self.config['testflight_url']}"
+        self.alerter.send(self.config, message)
@@ -0,0 +1,116 @@
+import threading
+import time
+from array import array
+from datetime import datetime, timezone
+
+# Log levels in code order; entries store the index, not the string
+LEVELS = ('info', 'success', 'warning', 'error')
+LEVEL_CODES = {level: code for code, level in enumerate(LEVELS)}
+
+# Status of a monitor that has never run
+IDLE_STATUS = {
+    'running': False,
+    'last_check': None,
+    'last_result': None,
+    'last_changed': None,
+    'already_alerted': False,
+    'error_count': 0,
+    'checks': 0,
+    'alerts': 0,
+    'connections': {}
+}
+
+
+def now_ms():
+    """Current time as integer epoch milliseconds"""
+    return time.time_ns() // 1000000
+
+
+def from_ms(ms):
+    """Naive UTC datetime for epoch milliseconds, or None for 0/None"""
+    if not ms:
+        return None
+    return datetime.fromtimestamp(ms / 1000, timezone.utc).replace(tzinfo=None)
+
+
+def to_ms(timestamp):
+    """Epoch milliseconds for a naive UTC datetime"""
+    return int(timestamp.replace(tzinfo=timezone.utc).timestamp() * 1000)
+
+
+class LogEntry:
+    """One monitor log line: epoch-millisecond timestamp, level code and message
+
+    Three slots and an int take about a third of the memory of the dict
+    and datetime they replace, which adds up over a ring buffer per
+    monitor. level and created give the display form when rendering.
+    """
+
+    __slots__ = ('timestamp', 'level_code', 'message')
+
+    def __init__(self, timestamp, level_code, message):
+        self.timestamp = timestamp
+        self.level_code = level_code
+        self.message = message
+
+    @classmethod
+    def create(cls, level, message, timestamp=None):
+        return cls(now_ms() if timestamp is None else timestamp, LEVEL_CODES[level], message)
+
+    @property
+    def level(self):
+        return LEVELS[self.level_code]
+
+    @property
+    def created(self):
+        """Timestamp as a naive UTC datetime"""
+        return from_ms(self.timestamp)
+
+    def __repr__(self):
+        return f"LogEntry({self.created!r}, {self.level!r}, {self.message!r})"
+
+
+class CounterTable:
+    """Integer fields for many objects, stored column-wise in arrays
+
+    Each field is one array('q'); an object owns a row index from
+    allocate() and gives it back with release(), after which the row is
+    zeroed and reused. A row costs 8 bytes per field instead of an int
+    object and a dict slot each. Writes to one row must not race each
+    other; different rows are independent.
+    """
+
+    def __init__(self, fields):
+        self.fields = tuple(fields)
+        self.columns = {field: array('q') for field in self.fields}
+        self._free = []
+        self._lock = threading.Lock()
+
+    def allocate(self):
+        """Claim a zeroed row; returns its index"""
+        with self._lock:
+            if self._free:
+                row = self._free.pop()
+                for column in self.columns.values():
+                    column[row] = 0
+                return row
+            for column in self.columns.values():
+                column.append(0)
+            return len(column) - 1
+
+    def release(self, row):
+        with self._lock:
+            self._free.append(row)
+
+    def get(self, row, field):
+        return self.columns[field][row]
+
+    def set(self, row, field, value):
+        self.columns[field][row] = value
+
+    def add(self, row, field, amount=1):
+        self.columns[field][row] += amount
+
+    def __len__(self):
+        """Rows in use"""
+        return len(self.columns[self.fields[0]]) - len(self._free)
@@ -0,0 +1,252 @@
+import functools
+import logging
+import threading
+
+from database import db
+from urls import normalize_url
+from models import MonitorConfig
+
+CONFIG_FIELDS = ('bot_token', 'chat_id', 'testflight_url', 'check_interval')
+
+
+class MonitorRegistry:
+    """Every configured monitor, persisted in the MonitorConfig table
+
+    Monitors are indexed in memory by id and by normalized URL. Creating,
+    updating or deleting one takes effect on the polling engine right
+    away, and load() restarts the ones that were running before a restart.
+
+    Without a store monitors run in this process, which assumes a single
+    web worker. With a shared_state.SharedStateStore (MONITOR_WORKERS mode)
+    they are RemoteMonitors run by the shard processes, and any web worker
+    can serve any monitor.
+    """
+
+    def __init__(self, app, history=None, store=None):
+        self.app = app
+        self.history = history
+        self.store = store
+        self.by_id = {}  # id -> monitor
+        self.configs = {}  # id -> config dict, so lookups never touch the store
+        self.by_url = {}  # normalized URL -> set of ids
+        self._lock = threading.RLock()
+
+    @staticmethod
+    def key_for(monitor_id):
+        """Engine and shared-store key for a monitor id"""
+        return f"monitor-{monitor_id}"
+
+    def load(self):
+        """Index every stored monitor and start the ones flagged running"""
+        with self.app.app_context():
+            rows = [(row.id, row.to_config(), bool(row.running), bool(row.already_alerted))
+                    for row in MonitorConfig.query.all()]
+
+        with self._lock:
+            if self.store:
+                # One transaction instead of one per monitor
+                self.store.set_desired_many([(self.key_for(id), config, running) for id, config, running, _ in rows])
+            for monitor_id, config, running, alerted in rows:
+                monitor = self._index(monitor_id, config, push_config=not self.store)
+                if self.store:
+                    continue
+                if alerted:
+                    monitor.already_alerted = monitor.last_result = True
+                if running:
+                    monitor.start(stagger=True)
+
+        logging.info(f"Loaded {len(rows)} monitors ({sum(running for _, _, running, _ in rows)} running)")
+        return len(rows)
+
+    def __len__(self):
+        return len(self.by_id)
+
+    def __contains__(self, monitor_id):
+        return monitor_id in self.by_id
+
+    def ids(self):
+        return list(self.by_id)
+
+    def get(self, monitor_id):
+        """Monitor for an id, or None
+
+        Falls back to the database so a monitor created by another web
+        worker is picked up on first use.
+        """
+        monitor = self.by_id.get(monitor_id)
+        if monitor is not None or monitor_id is None:
+            return monitor
+        with self.app.app_context():
+            row = db.session.get(MonitorConfig, monitor_id)
+            config = row and row.to_config()
+        if config is None:
+            return None
+        with self._lock:
+            return self.by_id.get(monitor_id) or self._index(monitor_id, config, push_config=not self.store)
+
+    def find(self, testflight_url, chat_id=None):
+        """Ids of monitors watching a URL, optionally only those alerting chat_id"""
+        ids = self.by_url.get(normalize_url(testflight_url), ())
+        if chat_id is None:
+            return sorted(ids)
+        return sorted(id for id in ids if str(self.configs[id]['chat_id']) == str(chat_id))
+
+    def create(self, config, running=False):
+        """Store a new monitor and start it if running; returns its id"""
+        with self.app.app_context():
+            row = MonitorConfig(**{field: config[field] for field in CONFIG_FIELDS}, running=running)
+            db.session.add(row)
+            db.session.commit()
+            monitor_id = row.id
+            config = row.to_config()
+
+        with self._lock:
+            monitor = self._index(monitor_id, config)
+        if running:
+            monitor.start(stagger=True)
+        return monitor_id
+
+    def create_many(self, configs, running=False):
+        """Store many new monitors in one transaction and start them if running; returns their ids
+
+        running is one flag for all of them or a list with one per config.
+        """
+        flags = [running] * len(configs) if isinstance(running, bool) else list(running)
+        with self.app.app_context():
+            rows = [MonitorConfig(**{field: config[field] for field in CONFIG_FIELDS}, running=flag)
+                    for config, flag in zip(configs, flags)]
+            db.session.add_all(rows)
+            db.session.flush()  # assigns ids; read them before commit expires every row
+            created = [(row.id, row.to_config()) for row in rows]
+            db.session.commit()
+
+        with self._lock:
+            if self.store:
+                self.store.set_desired_many([(self.key_for(id), config, flag)
+                                             for (id, config), flag in zip(created, flags)])
+            monitors = [self._index(monitor_id, config, push_config=not self.store) for monitor_id, config in created]
+        if not self.store:
+            for monitor, flag in zip(monitors, flags):
+                if flag:
+                    monitor.start(stagger=True)
+        logging.info("Created %d monitors", len(created))
+        return [monitor_id for monitor_id, _ in created]
+
+    def iter_configs(self, batch_size=500):
+        """(id, config, running) for every stored monitor, read in batches"""
+        last_id = 0
+        while True:
+            with self.app.app_context():
+                rows = [(row.id, row.to_config(), bool(row.running)) for row in
+                        MonitorConfig.query.filter(MonitorConfig.id > last_id)
+                        .order_by(MonitorConfig.id).limit(batch_size)]
+            if not rows:
+                return
+            yield from rows
+            last_id = rows[-1][0]
+
+    def update(self, monitor_id, config):
+        """Change some or all config fields of a monitor; returns False if it doesn't exist"""
+        with self.app.app_context():
+            row = db.session.get(MonitorConfig, monitor_id)
+            if row is None:
+                return False
+            for field in CONFIG_FIELDS:
+                if field in config:
+                    setattr(row, field, config[field])
+            db.session.commit()
+            new_config = row.to_config()
+
+        with self._lock:
+            monitor = self.get(monitor_id)
+            self._unindex_url(monitor_id, self.configs[monitor_id])
+            monitor.update_config(new_config)
+            self.configs[monitor_id] = new_config
+            self.by_url.setdefault(normalize_url(new_config['testflight_url']), set()).add(monitor_id)
+        return True
+
+    def delete(self, monitor_id):
+        """Stop and remove a monitor; returns False if it doesn't exist"""
+        with self.app.app_context():
+            row = db.session.get(MonitorConfig, monitor_id)
+            if row is None:
+                return False
+            db.session.delete(row)
+            db.session.commit()
+
+        with self._lock:
+            monitor = self.by_id.pop(monitor_id, None)
+            if monitor is not None:
+                monitor.stop()
+                self._unindex_url(monitor_id, self.configs.pop(monitor_id))
+            if self.store:
+                self.store.delete(self.key_for(monitor_id))
+        return True
+
+    def start(self, monitor_id):
+        """Start a monitor and remember it across restarts; False if already running"""
+        monitor = self.get(monitor_id)
+        if monitor is None:
+            raise Exception("No configuration available")
+        self._set_running(monitor_id, True)
+        return monitor.start()
+
+    def stop(self, monitor_id):
+        """Stop a monitor; False if it wasn't running"""
+        monitor = self.get(monitor_id)
+        if monitor is None:
+            return False
+        self._set_running(monitor_id, False)
+        return monitor.stop()
+
+    def _set_running(self, monitor_id, running):
+        with self.app.app_context():
+            MonitorConfig.query.filter_by(id=monitor_id).update({'running': running})
+            db.session.commit()
+
+    def _save_alert_state(self, monitor_id, alerted):
+        """Persist already_alerted; called from the check thread on the rare flips
+
+        Setting it is a compare-and-set, so when an old and a new worker
+        overlap during a rolling restart only one of them claims the alert.
+        Returns False if the flag was already set; True if the database is
+        unavailable, since a duplicate alert beats a missed one.
+        """
+        try:
+            with self.app.app_context():
+                query = MonitorConfig.query.filter_by(id=monitor_id)
+                if alerted:
+                    query = query.filter(MonitorConfig.already_alerted.isnot(True))  # NULL on upgraded rows
+                claimed = query.update({'already_alerted': alerted})
+                db.session.commit()
+            return bool(claimed) or not alerted
+        except Exception as e:
+            logging.error("Saving alert state failed: %s", e, extra={'monitor': self.key_for(monitor_id)})
+            return True
+
+    def _build(self, monitor_id):
+        from monitor import TestFlightMonitor
+        from shared_state import RemoteMonitor
+
+        key = self.key_for(monitor_id)
+        if self.store:
+            return RemoteMonitor(self.store, key)
+        return TestFlightMonitor(history=self.history, key=key,
+                                 on_alert_state=functools.partial(self._save_alert_state, monitor_id))
+
+    def _index(self, monitor_id, config, push_config=True):
+        monitor = self._build(monitor_id)
+        if push_config:
+            monitor.update_config(config)
+        self.by_id[monitor_id] = monitor
+        self.configs[monitor_id] = config
+        self.by_url.setdefault(normalize_url(config['testflight_url']), set()).add(monitor_id)
+        return monitor
+
+    def _unindex_url(self, monitor_id, config):
+        url = normalize_url(config['testflight_url'])
+        ids = self.by_url.get(url)
+        if ids:
+            ids.discard(monitor_id)
+            if not ids:
+                del self.by_url[url]
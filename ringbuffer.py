@@ -0,0 +1,66 @@
+import threading
+
+
+class RingBuffer:
+    """Bounded store with O(1) append and lock-free snapshot reads
+
+    Every slot holds (seq, entry). The writer fills the slot before
+    publishing the new sequence number, and readers walk back from the
+    newest sequence and stop at the first slot that has been overwritten.
+    Readers therefore never block the writer and never see a torn view;
+    at worst a concurrent append trims the oldest entry of a snapshot.
+    """
+
+    def __init__(self, capacity=50):
+        if capacity < 1:
+            raise ValueError("capacity must be at least 1")
+        self.capacity = capacity
+        self._slots = [None] * capacity
+        self._seq = 0  # sequence number of the newest entry
+        self._floor = 0  # entries at or below this sequence were cleared
+        self._write_lock = threading.Lock()  # serializes writers only
+
+    def append(self, entry):
+        """Add an entry, overwriting the oldest when full; returns its sequence"""
+        with self._write_lock:
+            seq = self._seq + 1
+            self._slots[seq % self.capacity] = (seq, entry)
+            self._seq = seq
+        return seq
+
+    def clear(self):
+        """Hide all current entries from readers"""
+        with self._write_lock:
+            self._floor = self._seq
+
+    @property
+    def last_seq(self):
+        """Sequence number of the newest entry (0 if nothing was ever added)"""
+        return self._seq
+
+    def items_since(self, seq=0, limit=None):
+        """(seq, entry) pairs newer than seq, most recent first"""
+        slots = self._slots
+        capacity = self.capacity
+        head = self._seq
+        low = max(seq, self._floor, head - capacity)
+        items = []
+        for current in range(head, low, -1):
+            slot = slots[current % capacity]
+            if slot is None or slot[0] != current:
+                break  # overwritten by a newer append
+            items.append(slot)
+            if limit and len(items) >= limit:
+                break
+        return items
+
+    def since(self, seq=0, limit=None):
+        """Entries newer than seq, most recent first"""
+        return [entry for _, entry in self.items_since(seq, limit)]
+
+    def snapshot(self):
+        """All retained entries, most recent first"""
+        return self.since()
+
+    def __len__(self):
+        return min(self._seq - self._floor, self.capacity)
@@ -0,0 +1,305 @@
+import json
+import os
+import sqlite3
+import threading
+import time
+from datetime import datetime
+
+import lifecycle
+from records import IDLE_STATUS, LEVEL_CODES, LogEntry, to_ms
+
+DEFAULT_STATE_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'monitor_state.db')
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS monitor_desired (
+    key TEXT PRIMARY KEY,
+    config TEXT NOT NULL,
+    running INTEGER NOT NULL DEFAULT 0,
+    updated_at REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS monitor_status (
+    key TEXT PRIMARY KEY,
+    status TEXT NOT NULL,
+    version INTEGER NOT NULL DEFAULT 0,
+    shard INTEGER,
+    updated_at REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS monitor_logs (
+    seq INTEGER PRIMARY KEY AUTOINCREMENT,
+    key TEXT NOT NULL,
+    timestamp TEXT NOT NULL,
+    level TEXT NOT NULL,
+    message TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS ix_monitor_logs_key_seq ON monitor_logs (key, seq);
+CREATE TABLE IF NOT EXISTS monitor_metrics (
+    shard INTEGER PRIMARY KEY,
+    families TEXT NOT NULL,
+    updated_at REAL NOT NULL
+);
+'''
+
+
+_TIMESTAMPS = ('last_check', 'last_changed')
+
+
+def _encode_status(status):
+    status = dict(status)
+    for field in _TIMESTAMPS:
+        if isinstance(status.get(field), datetime):
+            status[field] = status[field].isoformat()
+    return json.dumps(status)
+
+
+def _decode_status(text):
+    status = json.loads(text)
+    for field in _TIMESTAMPS:
+        if status.get(field):
+            status[field] = datetime.fromisoformat(status[field])
+    return status
+
+
+class SharedStateStore:
+    """SQLite store shared by web workers and monitor shard processes
+
+    Web workers write the desired config and running flag for each monitor
+    key; the shard that owns the key applies it and publishes status and
+    log entries back, so every web worker sees the same state.
+    """
+
+    def __init__(self, path=None, log_capacity=50):
+        self.path = path or os.environ.get('MONITOR_STATE_DB', DEFAULT_STATE_PATH)
+        self.log_capacity = log_capacity
+        self._local = threading.local()
+        self._db().executescript(SCHEMA)
+        # A forked child opens its own connections instead of sharing these
+        os.register_at_fork(after_in_child=self._forget_connections)
+
+    def _forget_connections(self):
+        self._local = threading.local()
+
+    def _db(self):
+        """This thread's connection, in autocommit mode for plain reads"""
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=10, isolation_level=None)
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('PRAGMA synchronous=NORMAL')
+            self._local.conn = conn
+        return conn
+
+    def _write(self):
+        """Write transaction on this thread's connection"""
+        return _Transaction(self._db())
+
+    # Desired state, written by web workers
+
+    def set_desired(self, key, config=None, running=None):
+        """Update the config and/or running flag for key"""
+        with self._write() as conn:
+            row = conn.execute('SELECT config, running FROM monitor_desired WHERE key = ?', (key,)).fetchone()
+            new_config = json.dumps(config) if config is not None else (row[0] if row else None)
+            if new_config is None:
+                raise Exception("No configuration available")
+            new_running = int(running) if running is not None else (row[1] if row else 0)
+            conn.execute('INSERT OR REPLACE INTO monitor_desired (key, config, running, updated_at) VALUES (?, ?, ?, ?)',
+                         (key, new_config, new_running, time.time()))
+
+    def set_desired_many(self, rows):
+        """Write (key, config, running) for many monitors in one transaction"""
+        now = time.time()
+        with self._write() as conn:
+            conn.executemany('INSERT OR REPLACE INTO monitor_desired (key, config, running, updated_at) VALUES (?, ?, ?, ?)',
+                             [(key, json.dumps(config), int(running), now) for key, config, running in rows])
+
+    def get_desired(self, key):
+        """(config, running) for key, or (None, False)"""
+        conn = self._db()
+        row = conn.execute('SELECT config, running FROM monitor_desired WHERE key = ?', (key,)).fetchone()
+        return (json.loads(row[0]), bool(row[1])) if row else (None, False)
+
+    def load_desired(self):
+        """{key: (config, running)} for every monitor"""
+        conn = self._db()
+        rows = conn.execute('SELECT key, config, running FROM monitor_desired').fetchall()
+        return {key: (json.loads(config), bool(running)) for key, config, running in rows}
+
+    def delete(self, key):
+        """Forget a monitor entirely"""
+        with self._write() as conn:
+            conn.execute('DELETE FROM monitor_desired WHERE key = ?', (key,))
+            conn.execute('DELETE FROM monitor_status WHERE key = ?', (key,))
+            conn.execute('DELETE FROM monitor_logs WHERE key = ?', (key,))
+
+    # Published state, written by shards
+
+    def publish(self, updates, shard=None):
+        """Write status and new log entries for many keys in one transaction
+
+        updates is a list of (key, status dict or None, [(timestamp, level, message), ...]).
+        """
+        now = time.time()
+        with self._write() as conn:
+            for key, status, logs in updates:
+                if logs:
+                    conn.executemany('INSERT INTO monitor_logs (key, timestamp, level, message) VALUES (?, ?, ?, ?)',
+                                     [(key, timestamp.isoformat(), level, message) for timestamp, level, message in logs])
+                    self._trim(conn, key)
+                if status is not None:
+                    conn.execute('''INSERT INTO monitor_status (key, status, version, shard, updated_at) VALUES (?, ?, 1, ?, ?)
+                                    ON CONFLICT(key) DO UPDATE SET status = excluded.status, shard = excluded.shard,
+                                    version = version + 1, updated_at = excluded.updated_at''',
+                                 (key, _encode_status(status), shard, now))
+                elif logs:
+                    self._bump(conn, key)
+
+    def get_status(self, key):
+        """(status dict or None, version) for key"""
+        conn = self._db()
+        row = conn.execute('SELECT status, version FROM monitor_status WHERE key = ?', (key,)).fetchone()
+        return (_decode_status(row[0]), row[1]) if row else (None, 0)
+
+    def get_version(self, key):
+        conn = self._db()
+        row = conn.execute('SELECT version FROM monitor_status WHERE key = ?', (key,)).fetchone()
+        return row[0] if row else 0
+
+    # Metrics, written by shards so any web worker can serve /metrics
+
+    def publish_metrics(self, shard, families):
+        with self._write() as conn:
+            conn.execute('INSERT OR REPLACE INTO monitor_metrics (shard, families, updated_at) VALUES (?, ?, ?)',
+                         (shard, json.dumps(families), time.time()))
+
+    def load_metrics(self, max_age=60):
+        """Metric families from every shard that published within max_age seconds"""
+        conn = self._db()
+        rows = conn.execute('SELECT families FROM monitor_metrics WHERE updated_at > ? ORDER BY shard',
+                            (time.time() - max_age,)).fetchall()
+        return [family for (families,) in rows for family in json.loads(families)]
+
+    # Logs
+
+    def add_log(self, key, level, message, timestamp=None):
+        """Append one entry; returns its sequence number"""
+        with self._write() as conn:
+            cursor = conn.execute('INSERT INTO monitor_logs (key, timestamp, level, message) VALUES (?, ?, ?, ?)',
+                                  (key, (timestamp or datetime.utcnow()).isoformat(), level, message))
+            self._trim(conn, key)
+            self._bump(conn, key)
+        return cursor.lastrowid
+
+    def log_items(self, key, since=0, limit=None):
+        """(seq, entry) pairs newer than since, most recent first"""
+        conn = self._db()
+        rows = conn.execute('SELECT seq, timestamp, level, message FROM monitor_logs WHERE key = ? AND seq > ? '
+                            'ORDER BY seq DESC LIMIT ?', (key, since, limit or self.log_capacity)).fetchall()
+        return [(seq, LogEntry(to_ms(datetime.fromisoformat(timestamp)), LEVEL_CODES[level], message))
+                for seq, timestamp, level, message in rows]
+
+    def last_log_seq(self, key):
+        conn = self._db()
+        row = conn.execute('SELECT MAX(seq) FROM monitor_logs WHERE key = ?', (key,)).fetchone()
+        return row[0] or 0
+
+    def clear_logs(self, key):
+        with self._write() as conn:
+            conn.execute('DELETE FROM monitor_logs WHERE key = ?', (key,))
+            self._bump(conn, key)
+
+    def _trim(self, conn, key):
+        conn.execute('''DELETE FROM monitor_logs WHERE key = ? AND seq <= (
+                            SELECT seq FROM monitor_logs WHERE key = ? ORDER BY seq DESC LIMIT 1 OFFSET ?)''',
+                     (key, key, self.log_capacity))
+
+    def _bump(self, conn, key):
+        conn.execute('''INSERT INTO monitor_status (key, status, version, updated_at) VALUES (?, '{}', 1, ?)
+                        ON CONFLICT(key) DO UPDATE SET version = version + 1''', (key, time.time()))
+
+
+class _Transaction:
+    """BEGIN IMMEDIATE ... COMMIT around a block on an autocommit connection"""
+
+    def __init__(self, conn):
+        self.conn = conn
+
+    def __enter__(self):
+        self.conn.execute('BEGIN IMMEDIATE')
+        return self.conn
+
+    def __exit__(self, exc_type, exc, tb):
+        self.conn.execute('ROLLBACK' if exc_type else 'COMMIT')
+
+
+class RemoteMonitor:
+    """TestFlightMonitor look-alike whose monitor runs in a shard process
+
+    Used by web workers in worker-pool mode: commands go to the shared
+    store and status and logs are read back from it.
+    """
+
+    def __init__(self, store, key, poll_interval=0.5):
+        self.store = store
+        self.key = key
+        self.poll_interval = poll_interval
+
+    @property
+    def config(self):
+        return self.store.get_desired(self.key)[0]
+
+    @property
+    def version(self):
+        return self.store.get_version(self.key)
+
+    @property
+    def last_log_seq(self):
+        return self.store.last_log_seq(self.key)
+
+    def update_config(self, config):
+        self.store.set_desired(self.key, config=config)
+
+    def is_running(self):
+        status, _ = self.store.get_status(self.key)
+        return bool(status and status.get('running'))
+
+    def start(self, stagger=False):
+        config, running = self.store.get_desired(self.key)
+        if not config:
+            raise Exception("No configuration available")
+        if running:
+            return False
+        self.store.set_desired(self.key, running=True)
+        return True
+
+    def stop(self):
+        _, running = self.store.get_desired(self.key)
+        if not running:
+            return False
+        self.store.set_desired(self.key, running=False)
+        return True
+
+    def get_status(self):
+        status, _ = self.store.get_status(self.key)
+        return {**IDLE_STATUS, **(status or {})}
+
+    def add_log(self, level, message):
+        return self.store.add_log(self.key, level, message)
+
+    def get_logs(self, since=0):
+        return [entry for _, entry in self.get_log_items(since)]
+
+    def get_log_items(self, since=0, limit=None):
+        return self.store.log_items(self.key, since, limit)
+
+    def clear_logs(self):
+        self.store.clear_logs(self.key)
+
+    def wait_for_change(self, version, timeout):
+        """Poll the store until the version moves or timeout; returns the current version"""
+        deadline = time.monotonic() + (timeout or 0)
+        current = self.version
+        while current == version and time.monotonic() < deadline:
+            if lifecycle.stopping.wait(min(self.poll_interval, max(0, deadline - time.monotonic()))):
+                break
+            current = self.version
+        return current
@@ -0,0 +1,70 @@
+import time
+
+import pytest
+
+from alerts import AlertDispatcher, split_message, utf16_len
+from fake_telegram import FakeTelegramServer
+
+EMOJI = '\U0001F6A8'  # two UTF-16 units
+
+
+@pytest.fixture
+def telegram():
+    with FakeTelegramServer() as server:
+        server.retry_after = 0
+        yield server
+
+
+@pytest.fixture
+def dispatcher(telegram):
+    dispatcher = AlertDispatcher(api_base=telegram.url, coalesce_window=0.2, global_rate=100, chat_rate=100)
+    yield dispatcher
+    dispatcher.stop()
+
+
+def wait_for(condition, timeout=5):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        assert time.monotonic() < deadline, "timed out"
+        time.sleep(0.01)
+
+
+def test_split_counts_utf16_units():
+    assert split_message(EMOJI * 2048) == [EMOJI * 2048]
+    chunks = split_message('a' + EMOJI * 2048)
+    assert chunks == ['a' + EMOJI * 2047, EMOJI]
+    assert all(utf16_len(chunk) <= 4096 for chunk in chunks)
+
+
+def test_split_breaks_between_messages():
+    first, second = 'x' * 3000, 'y' * 3000
+    assert split_message(f"{first}\n\n{second}") == [first, second]
+
+
+def test_long_emoji_alert_is_delivered_in_order(telegram, dispatcher):
+    text = 'a' + EMOJI * 2048
+    dispatcher.enqueue('token', 1, text)
+    wait_for(lambda: len(telegram.messages) == 2)
+    received = [message['text'] for message in telegram.messages]
+    assert ''.join(received) == text
+    assert all(utf16_len(chunk) <= 4096 for chunk in received)
+
+
+def test_rate_limit_retries_only_unsent_chunks(telegram, dispatcher):
+    first, second = 'x' * 3000, 'y' * 3000
+    telegram.rate_limit_after = 1
+    telegram.rate_limit_next = 1
+    dispatcher.enqueue('token', 1, f"{first}\n\n{second}")
+    wait_for(lambda: dispatcher.get_stats()['sent'] == 1)
+    assert [message['text'] for message in telegram.messages] == [first, second]
+    assert telegram.requests == 3
+
+
+def test_same_chat_alerts_are_coalesced(telegram, dispatcher):
+    dispatcher.enqueue('token', 1, 'one')
+    dispatcher.enqueue('token', 1, 'two')
+    dispatcher.enqueue('token', 1, 'one')
+    dispatcher.enqueue('token', 2, 'other chat')
+    wait_for(lambda: len(telegram.messages) == 2)
+    texts = {message['chat_id']: message['text'] for message in telegram.messages}
+    assert texts == {'1': 'one\n\ntwo', '2': 'other chat'}
@@ -0,0 +1,17 @@
+from urllib.parse import urlsplit, urlunsplit
+
+
+def normalize_url(url):
+    """Canonical form of url so equivalent links share one fetch
+
+    Scheme and host are lowercased, default ports, fragments and trailing
+    slashes dropped. The path keeps its case since TestFlight join codes
+    are case-sensitive.
+    """
+    parts = urlsplit(url.strip())
+    scheme = parts.scheme.lower() or 'https'
+    host = (parts.hostname or '').lower()
+    if parts.port and parts.port != {'http': 80, 'https': 443}.get(scheme):
+        host = f"{host}:{parts.port}"
+    path = parts.path.rstrip('/') or '/'
+    return urlunsplit((scheme, host, path, parts.query, ''))
@@ -0,0 +1,212 @@
+import bisect
+import hashlib
+import logging
+import multiprocessing
+import os
+import signal
+import threading
+import time
+
+import lifecycle
+from urls import normalize_url
+from logging_setup import setup_logging
+from metrics import REGISTRY
+
+
+def _hash(value):
+    return int.from_bytes(hashlib.md5(value.encode()).digest()[:8], 'big')
+
+
+class HashRing:
+    """Consistent hashing of monitor URLs onto shard indexes
+
+    Each shard owns many virtual points on the ring so load stays even,
+    and growing or shrinking the pool only moves the URLs between
+    neighbouring points instead of reshuffling everything.
+    """
+
+    def __init__(self, nodes, replicas=64):
+        points = sorted((_hash(f"{node}:{i}"), node) for node in nodes for i in range(replicas))
+        self.hashes = [point for point, _ in points]
+        self.nodes = [node for _, node in points]
+
+    def node_for(self, key):
+        """Shard that owns key"""
+        index = bisect.bisect(self.hashes, _hash(key)) % len(self.hashes)
+        return self.nodes[index]
+
+
+class Shard:
+    """Runs the monitors one shard owns and mirrors them into the shared store"""
+
+    def __init__(self, index, count, store, history=None, metrics_interval=5.0):
+        self.index = index
+        self.ring = HashRing(range(count))
+        self.store = store
+        self.history = history
+        self.monitors = {}  # key -> TestFlightMonitor
+        self.published_seq = {}  # key -> last log seq written to the store
+        self.published_status = {}  # key -> last status written to the store
+        self.metrics_interval = metrics_interval
+        self.metrics_published_at = 0
+
+    def owns(self, config):
+        return self.ring.node_for(normalize_url(config['testflight_url'])) == self.index
+
+    def sync(self):
+        """Apply desired state for owned monitors, then publish their state"""
+        from monitor import TestFlightMonitor
+
+        desired = self.store.load_desired()
+        for key, (config, running) in desired.items():
+            if not self.owns(config):
+                continue
+            monitor = self.monitors.get(key)
+            if monitor is None:
+                monitor = self.monitors[key] = TestFlightMonitor(history=self.history, key=key)
+                self._restore(key, monitor)
+            if monitor.config != config:
+                monitor.update_config(config)
+            if running and not monitor.is_running():
+                monitor.start(stagger=True)
+            elif not running and monitor.is_running():
+                monitor.stop()
+
+        # Monitors that were deleted or rebalanced to another shard
+        released = [key for key, (config, _) in desired.items() if key in self.monitors and not self.owns(config)]
+        released += [key for key in self.monitors if key not in desired]
+        for key in released:
+            self.monitors[key].stop()
+
+        self.publish()
+        for key in released:
+            del self.monitors[key]
+            self.published_seq.pop(key, None)
+            self.published_status.pop(key, None)
+
+    def publish(self):
+        """Write changed status and new log entries in one transaction"""
+        updates = []
+        for key, monitor in self.monitors.items():
+            items = monitor.get_log_items(self.published_seq.get(key, 0))
+            status = monitor.get_status()
+            changed = status != self.published_status.get(key)
+            if items or changed:
+                logs = [(entry.created, entry.level, entry.message) for _, entry in reversed(items)]
+                updates.append((key, status if changed else None, logs))
+                if items:
+                    self.published_seq[key] = items[0][0]
+                self.published_status[key] = status
+        if updates:
+            self.store.publish(updates, shard=self.index)
+
+        now = time.monotonic()
+        if now - self.metrics_published_at >= self.metrics_interval:
+            self.metrics_published_at = now
+            self.store.publish_metrics(self.index, REGISTRY.collect({'shard': str(self.index)}))
+
+    def stop_all(self):
+        for monitor in self.monitors.values():
+            monitor.stop()
+        self.publish()
+
+    def _restore(self, key, monitor):
+        """Carry alert state over from the previous owner so it doesn't alert twice"""
+        status, _ = self.store.get_status(key)
+        if status:
+            monitor.already_alerted = status.get('already_alerted', False)
+            monitor.last_result = status.get('last_result')
+
+
+def run_shard(index, count, state_path=None, sync_interval=1.0):
+    """Entry point of a shard worker process"""
+    from shared_state import SharedStateStore
+
+    setup_logging()
+    signal.signal(signal.SIGTERM, lambda signum, frame: lifecycle.stopping.set())
+    signal.signal(signal.SIGINT, lambda signum, frame: lifecycle.stopping.set())
+
+    shard = Shard(index, count, SharedStateStore(state_path), history=_shard_history())
+    logging.info(f"Monitor shard {index}/{count} started (pid {os.getpid()})")
+    while not lifecycle.stopping.is_set():
+        try:
+            shard.sync()
+        except Exception as e:
+            logging.error(f"Shard {index} sync failed: {e}")
+        lifecycle.stopping.wait(sync_interval)
+    # Finish in-flight checks and publish the final alert state before
+    # delivering queued alerts and flushing history
+    shard.stop_all()
+    lifecycle.shutdown()
+    logging.info(f"Monitor shard {index}/{count} stopped")
+
+
+def _shard_history():
+    """History writer bound to a minimal app, so shards persist like the web app does"""
+    from flask import Flask
+    from database import init_db
+    from history import HistoryWriter
+
+    app = Flask('monitor_shard')
+    init_db(app)
+    return HistoryWriter(app)
+
+
+class WorkerPool:
+    """Supervises one process per shard and restarts any that die"""
+
+    def __init__(self, count, state_path=None, sync_interval=1.0):
+        self.count = count
+        self.state_path = state_path
+        self.sync_interval = sync_interval
+        self.processes = [None] * count
+        self.context = multiprocessing.get_context('spawn')
+        self.thread = None
+        self._stopping = threading.Event()
+
+    def start(self):
+        for index in range(self.count):
+            self._spawn(index)
+        self.thread = threading.Thread(target=self._supervise, daemon=True, name='worker-pool')
+        self.thread.start()
+
+    def stop(self, timeout=10):
+        self._stopping.set()
+        for process in self.processes:
+            if process and process.is_alive():
+                process.terminate()  # SIGTERM: the shard stops its monitors and publishes
+        for process in self.processes:
+            if process:
+                process.join(timeout)
+
+    def _spawn(self, index):
+        process = self.context.Process(target=run_shard, name=f'monitor-shard-{index}',
+                                       args=(index, self.count, self.state_path, self.sync_interval))
+        process.start()
+        self.processes[index] = process
+
+    def _supervise(self):
+        while not self._stopping.wait(5):
+            for index, process in enumerate(self.processes):
+                if not process.is_alive() and not self._stopping.is_set():
+                    logging.warning(f"Monitor shard {index} exited with {process.exitcode}, restarting")
+                    self._spawn(index)
+
+
+def worker_count():
+    """Shard processes to run, from MONITOR_WORKERS (0 means monitors run in-process)"""
+    return int(os.environ.get('MONITOR_WORKERS', 0) or 0)
+
+
+if __name__ == '__main__':
+    setup_logging()
+    pool = WorkerPool(worker_count() or os.cpu_count() or 1)
+    pool.start()
+    stopping = threading.Event()
+    signal.signal(signal.SIGTERM, lambda signum, frame: stopping.set())
+    try:
+        while not stopping.wait(1):
+            pass
+    except KeyboardInterrupt:
+        pass
+    pool.stop()